@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Calculates the working memory scores discussed in Conway et al. (2005)
+for the protocols of many participants at once.  This is a port of
+calculate_wmscores.R: all protocols are loaded into one set of NumPy
+arrays and the scores of all participants are computed together.
+
+Usage: python wmscores.py [-t threshold] [-o cohort.tsv] file1.tsv file2.tsv ...
+"""
+
+import sys, os, argparse
+import numpy as np
+
+# Scores in the order in which they are reported:
+measures = ["wmc", "pcu", "anu", "pcl", "anl", "accuracy"]
+
+# Columns needed for calculating the scores:
+needed_columns = ["phase", "num.items", "correctly.recalled", "correctly.verified"]
+
+def table_columns(filename):
+  """
+  Returns the column names of the table in a file (None if there is
+  no table).
+  """
+  for l in open(filename, encoding='utf-8'):
+    if l.startswith("#") or not l.strip():
+      continue
+    return l.rstrip("\r\n").split("\t")
+  return None
+
+def is_results_file(filename):
+  """
+  Whether a file contains a table of results (and not e.g. the timing
+  statistics stored next to it).
+  """
+  columns = table_columns(filename)
+  return columns is not None and all(c in columns for c in needed_columns)
+
+def read_protocols(filenames, phase="test"):
+  """
+  Reads the results tables of the given protocols.  Returns a
+  dictionary with one array per column (num.items, correctly.recalled,
+  correctly.verified) plus an array subject holding, for each set, the
+  index of the file it came from.  Only sets of the given phase are
+  included.  Files without a table of results are skipped.
+  """
+  subject = []
+  num_items = []
+  recalled = []
+  verified = []
+  for n, filename in enumerate(filenames):
+    columns = None
+    for l in open(filename, encoding='utf-8'):
+      if l.startswith("#") or not l.strip():
+        continue
+      row = l.rstrip("\r\n").split("\t")
+      if columns is None:
+        columns = dict((c, i) for i, c in enumerate(row))
+        if not all(c in columns for c in needed_columns):
+          break
+        continue
+      if row[columns["phase"]] != phase:
+        continue
+      subject.append(n)
+      num_items.append(row[columns["num.items"]])
+      recalled.append(row[columns["correctly.recalled"]])
+      verified.append(row[columns["correctly.verified"]])
+  return {"subject":np.array(subject, dtype=np.intp),
+          "num.items":np.array(num_items, dtype=np.int64),
+          "correctly.recalled":np.array(recalled, dtype=np.int64),
+          "correctly.verified":np.array(verified, dtype=np.int64)}
+
+def wm_scores(filenames, threshold=2/3):
+  """
+  Calculates wmc, pcu, anu, pcl, anl, and accuracy for each of the
+  given protocols.  Returns a dictionary mapping the names of the
+  scores to arrays with one value per protocol.  Protocols without test
+  sets get NaN (and a wmc of 0).
+  """
+  d = read_protocols(filenames)
+  n = len(filenames)
+  subject = d["subject"]
+  num_items = d["num.items"]
+  recalled = d["correctly.recalled"]
+  perfect = recalled == num_items
+
+  def per_subject(x):
+    return np.bincount(subject, weights=x, minlength=n)
+
+  with np.errstate(invalid="ignore", divide="ignore"):
+    sets = per_subject(np.ones(len(subject)))
+    total_items = per_subject(num_items)
+    scores = {
+      "pcu":per_subject(recalled / num_items) / sets,
+      "anu":per_subject(perfect) / sets,
+      "pcl":per_subject(recalled) / total_items,
+      "anl":per_subject(num_items * perfect) / total_items,
+      "accuracy":per_subject(d["correctly.verified"]) / total_items}
+
+    # Working memory capacity: the largest set size at which more
+    # than threshold of the sets were recalled perfectly.
+    levels, level = np.unique(num_items, return_inverse=True)
+    group = subject * len(levels) + level
+    group_sets = np.bincount(group, minlength=n*len(levels))
+    group_perfect = np.bincount(group, weights=perfect, minlength=n*len(levels))
+    passed = (group_perfect / group_sets > threshold).reshape(n, len(levels))
+  wmc = np.where(passed, levels, 0)
+  scores["wmc"] = wmc.max(axis=1) if len(levels) else np.zeros(n, dtype=np.int64)
+
+  return scores
+
+def write_cohort_table(fh, filenames, scores):
+  """
+  Writes the scores of all protocols as a tab-separated table with one
+  row per protocol to the file object fh.
+  """
+  fh.write("\t".join(["subject"] + measures) + "\n")
+  for i, f in enumerate(filenames):
+    fh.write("\t".join([os.path.basename(f), "%d" % scores["wmc"][i]]
+                       + ["%.3f" % scores[m][i] for m in measures[1:]]) + "\n")
+
+if __name__=="__main__":
+
+  parser = argparse.ArgumentParser(
+    description="Calculate working memory scores for a cohort of participants.")
+  parser.add_argument("files", nargs="+", help="results files written by Py-Span-Task")
+  parser.add_argument("-t", "--threshold", type=float, default=2/3,
+                      help="proportion of perfectly recalled sets needed for wmc (default: 2/3)")
+  parser.add_argument("-o", "--output",
+                      help="file for the cohort table (default: standard output)")
+  args = parser.parse_args()
+
+  filenames = []
+  for f in args.files:
+    if is_results_file(f):
+      filenames.append(f)
+    else:
+      print("%s: not a results file, skipped" % f, file=sys.stderr)
+
+  scores = wm_scores(filenames, args.threshold)
+  if args.output:
+    with open(args.output, 'w', encoding='utf-8') as fh:
+      write_cohort_table(fh, filenames, scores)
+  else:
+    write_cohort_table(sys.stdout, filenames, scores)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the parts of Py-Span-Task whose speed matters: string
+distances, scoring, the sanity checks and loading of the bundled
+tests, and the generation of complete sessions.  The results are
+stored as JSON and can be compared with a baseline from an earlier
+run.
+
+Usage: python benchmarks.py [-o benchmarks.json] [--baseline baseline.json] [-t 1.25]
+"""
+
+import os, sys, io, glob, json, random, argparse, platform, tempfile, timeit, contextlib
+
+from pyspantask import damerau_levenshtein, calculate_score, read_configuration, complete_configuration, compile_materials, load_materials, validate_configuration, configure, simulate_session, SimulatedParticipant
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def random_words(rng, n, length):
+  return ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for i in range(length))
+          for j in range(n)]
+
+def task_directories():
+  """
+  The directories of all tests included in this repository.
+  """
+  return sorted(os.path.dirname(f) for f in
+                glob.glob(os.path.join(here, "*", "configuration.py")))
+
+def load_task(directory):
+  settings = read_configuration(os.path.join(directory, "configuration.py"))
+  complete_configuration(settings)
+  return settings
+
+def task_files(directory, settings):
+  return (os.path.join(directory, settings["target_items_file"]),
+          os.path.join(directory, settings["processing_items_file"]))
+
+def benchmarks(tmp):
+  """
+  Returns a list of (name, function) pairs.  Each function performs
+  the measured operation once.  Compiled materials are stored in the
+  directory tmp.
+  """
+  rng = random.Random(1)
+  l = []
+
+  for length in [4, 8, 16, 32, 64]:
+    pairs = list(zip(random_words(rng, 20, length), random_words(rng, 20, length)))
+    l.append(("damerau_levenshtein/%d" % length,
+              lambda pairs=pairs:[damerau_levenshtein(a, b) for a, b in pairs]))
+
+  for size in range(2, 11):
+    t = random_words(rng, size, 6)
+    # Responses with some omissions, typos, and swaps:
+    s = [w[:2] + w[3] + w[2] + w[4:] if rng.random() < 0.3 else w
+         for w in t if rng.random() < 0.8]
+    rng.shuffle(s)
+    l.append(("calculate_score/%d" % size,
+              lambda s=s, t=t:calculate_score(s, t, True, True, 1)))
+
+  for directory in task_directories():
+    name = os.path.basename(directory)
+    settings = load_task(directory)
+    files = task_files(directory, settings)
+    materials = compile_materials(*(files + (settings["errors_allowed"],)))
+    bundle = os.path.join(tmp, name + ".materials.json")
+    load_materials(*(files + (settings["errors_allowed"], bundle)))
+    l.append(("compile_materials/%s" % name,
+              lambda files=files, settings=settings:
+                compile_materials(*(files + (settings["errors_allowed"],)))))
+    l.append(("load_materials/%s" % name,
+              lambda files=files, settings=settings, bundle=bundle:
+                load_materials(*(files + (settings["errors_allowed"], bundle)))))
+    l.append(("validate_configuration/%s" % name,
+              lambda settings=settings, materials=materials:
+                validate_configuration(settings, materials)))
+
+  directory = os.path.join(here, "EnglishOperationSpan")
+  settings = load_task(directory)
+  materials = load_materials(*task_files(directory, settings))
+  def session():
+    configure(settings, materials)
+    participant = SimulatedParticipant(rng=random.Random(1))
+    # The scripts report each set on standard output:
+    with contextlib.redirect_stdout(io.StringIO()):
+      simulate_session(settings, materials, participant, "benchmark")
+  l.append(("session/EnglishOperationSpan", session))
+
+  return l
+
+def measure(func, repeat=5):
+  """
+  Returns the time in seconds that func takes per call (the best of
+  repeat runs).
+  """
+  timer = timeit.Timer(func)
+  number, elapsed = timer.autorange()
+  return min([elapsed] + timer.repeat(repeat - 1, number)) / number
+
+def compare(results, baseline, threshold, thresholds={}):
+  """
+  Compares results with a baseline.  Returns a list of (name, ratio)
+  pairs for the benchmarks that are slower than the baseline by more
+  than their threshold.
+  """
+  regressions = []
+  for name, seconds in sorted(results.items()):
+    if name not in baseline:
+      continue
+    ratio = seconds / baseline[name]
+    if ratio > thresholds.get(name, threshold):
+      regressions.append((name, ratio))
+  return regressions
+
+def parse_threshold(s):
+  name, factor = s.rsplit("=", 1)
+  return name, float(factor)
+
+if __name__=="__main__":
+
+  parser = argparse.ArgumentParser(
+    description="Measure the speed of Py-Span-Task and compare it with a baseline.")
+  parser.add_argument("-o", "--output", default="benchmarks.json",
+                      help="file for the results (default: benchmarks.json)")
+  parser.add_argument("-b", "--baseline",
+                      help="results of an earlier run to compare with")
+  parser.add_argument("-t", "--threshold", type=float, default=1.25,
+                      help="tolerated slowdown relative to the baseline (default: 1.25)")
+  parser.add_argument("--benchmark-threshold", type=parse_threshold, action="append",
+                      default=[], metavar="NAME=FACTOR",
+                      help="tolerated slowdown for a single benchmark")
+  parser.add_argument("-k", "--filter", default="",
+                      help="only run benchmarks whose name contains this string")
+  parser.add_argument("-r", "--repeat", type=int, default=5,
+                      help="number of measurements per benchmark (default: 5)")
+  args = parser.parse_args()
+
+  baseline = None
+  if args.baseline:
+    with open(args.baseline, encoding='utf-8') as fh:
+      baseline = json.load(fh)["benchmarks"]
+
+  results = {}
+  with tempfile.TemporaryDirectory() as tmp:
+    for name, func in benchmarks(tmp):
+      if args.filter not in name:
+        continue
+      results[name] = measure(func, args.repeat)
+      line = "%-48s %12.1f µs" % (name, results[name] * 1e6)
+      if baseline and name in baseline:
+        line += "  %5.2fx" % (results[name] / baseline[name])
+      print(line)
+
+  with open(args.output, 'w', encoding='utf-8') as fh:
+    json.dump({"python":platform.python_version(),
+               "platform":platform.platform(),
+               "benchmarks":results}, fh, indent=2, sort_keys=True)
+
+  if baseline:
+    regressions = compare(results, baseline, args.threshold,
+                          dict(args.benchmark_threshold))
+    for name, ratio in regressions:
+      print("%s is %.2f times slower than the baseline." % (name, ratio), file=sys.stderr)
+    sys.exit(1 if regressions else 0)
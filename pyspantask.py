@@ -9,53 +9,309 @@ __author__    = "Titus von der Malsburg <malsburg@posteo.de>"
 __copyright__ = "Copyright 2010, Titus von der Malsburg"
 __license__   = "GPL v2"
 
-import sys, os, re, math, time, random
+import sys, os, re, math, time, random, argparse, glob, hashlib, json, subprocess
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+import heapq, bisect, functools, contextlib, io
 import tkinter, tkinter.dnd, tkinter.filedialog
 from tkinter.constants import PAGES, UNITS, NORMAL, RAISED, SUNKEN, HORIZONTAL, RIGHT, BOTH, LEFT, BOTTOM, TOP, NW, HIDDEN, X, Y, ALL, CENTER
 from warnings import warn
 
-def damerau_levenshtein(s1, s2, eq=None):
+def damerau_levenshtein(s1, s2, eq=None, max_distance=None,
+                        transpositions=True):
   """
-  Compute the Damerau-Levenshtein distance between two sequences.
+  Compute the Damerau-Levenshtein distance (optimal string alignment)
+  between two sequences.
+
+  Only the last three rows of the dynamic programming matrix are kept.
+  If max_distance is given, the computation stops as soon as the
+  distance is known to exceed it and max_distance+1 is returned.  With
+  transpositions=False, the plain Levenshtein distance is computed.
   """
-  if not eq:
-    eq = lambda s,t:s==t
-  d = {}
   len1 = len(s1)
   len2 = len(s2)
-  for i in range(-1,len1+1):
-    d[(i,-1)] = i+1
-  for j in range(-1,len2+1):
-    d[(-1,j)] = j+1
-
-  for i in range(0,len1):
-    for j in range(0,len2):
-      if eq(s1[i], s2[j]):
+  if max_distance is not None:
+    if abs(len1 - len2) > max_distance:
+      return max_distance + 1
+    bound = max_distance + 1
+  else:
+    bound = None
+  if not eq:
+    eq = lambda s,t:s==t
+
+  prev2 = None
+  prev = list(range(len2 + 1))
+  for i in range(1, len1 + 1):
+    c1 = s1[i-1]
+    cur = [i] + [0] * len2
+    for j in range(1, len2 + 1):
+      if eq(c1, s2[j-1]):
         cost = 0
       else:
         cost = 1
-      d[(i,j)] = min(d[(i-1,j)] + 1,                 # deletion
-                     d[(i,j-1)] + 1,                 # insertion
-                     d[(i-1,j-1)] + cost)            # substitution
-      if i>0 and j>0 and eq(s1[i], s2[j-1]) and eq(s1[i-1], s2[j]):
-        d[(i,j)] = min (d[(i,j)], d[i-2,j-2] + cost) # transposition
+      d = min(prev[j] + 1,                   # deletion
+              cur[j-1] + 1,                  # insertion
+              prev[j-1] + cost)              # substitution
+      if (transpositions and i>1 and j>1 and eq(c1, s2[j-2])
+          and eq(s1[i-2], s2[j-1])):
+        d = min(d, prev2[j-2] + cost)        # transposition
+      cur[j] = d
+    # Two consecutive rows above the threshold mean that no alignment
+    # can get back below it:
+    if bound is not None and min(cur) >= bound and min(prev) >= bound:
+      return bound
+    prev2, prev = prev, cur
+
+  if bound is not None and prev[len2] > bound:
+    return bound
+  return prev[len2]
+
+def bitparallel_damerau_levenshtein(s1, s2, max_distance=None):
+  """
+  Compute the same distance as damerau_levenshtein for two strings
+  using Hyyrö's bit-parallel algorithm.  Each column of the dynamic
+  programming matrix is encoded in the bits of one integer, so the
+  running time is linear in the length of s2 as long as s1 fits into a
+  machine word (longer words still work but get slower).  The
+  max_distance cut-off has the same meaning as in damerau_levenshtein.
+  """
+  m = len(s1)
+  n = len(s2)
+  if max_distance is not None and abs(m - n) > max_distance:
+    return max_distance + 1
+  if m == 0:
+    score = n
+  else:
+    # Positions at which each character occurs in s1:
+    peq = {}
+    for i, c in enumerate(s1):
+      peq[c] = peq.get(c, 0) | (1 << i)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    vp = mask
+    vn = 0
+    d0 = 0
+    pm_prev = 0
+    score = m
+    for c in s2:
+      pm = peq.get(c, 0)
+      tr = (((~d0) & pm) << 1) & pm_prev
+      d0 = ((((pm & vp) + vp) & mask) ^ vp) | pm | vn | tr
+      hp = vn | (~(d0 | vp) & mask)
+      hn = d0 & vp
+      if hp & last:
+        score += 1
+      elif hn & last:
+        score -= 1
+      x = ((hp << 1) | 1) & mask
+      vn = x & d0
+      vp = ((hn << 1) & mask) | (~(x | d0) & mask)
+      pm_prev = pm
+  if max_distance is not None and score > max_distance:
+    return max_distance + 1
+  return score
+
+def word_distance(w1, w2, max_distance=None):
+  """
+  Damerau-Levenshtein distance between two recalled or target items.
+  Strings are handled by the bit-parallel implementation, anything
+  else by the general one.
+  """
+  if isinstance(w1, str) and isinstance(w2, str):
+    return bitparallel_damerau_levenshtein(w1, w2, max_distance)
+  return damerau_levenshtein(w1, w2, max_distance=max_distance)
 
-  return d[len1-1,len2-1]
+def deletion_neighbourhood(w, k):
+  """
+  Returns the set of all strings that can be obtained from w by
+  deleting at most k characters.
+  """
+  result = set([w])
+  frontier = [w]
+  for _ in range(k):
+    new = []
+    for v in frontier:
+      for i in range(len(v)):
+        d = v[:i] + v[i+1:]
+        if d not in result:
+          result.add(d)
+          new.append(d)
+    frontier = new
+  return result
+
+class SimilarityIndex(object):
+  """
+  Index over a pool of items for finding all items within a given
+  Damerau-Levenshtein distance of a query.
+
+  Two strings within distance k share at least one string that can be
+  obtained from each by deleting at most k characters.  Items are
+  therefore filed under their deletion neighbourhood and only items
+  sharing a key with the query are compared.  (A BK-tree would need a
+  proper metric, which the optimal string alignment distance is not.)
+  """
 
-def calculate_score(s, t, allow_sloppy_spelling, heed_order):
-  # Allow one typo: omission, addition, substitution of a character, or
-  # transposition of two characters.
-  if allow_sloppy_spelling:
-    errors_allowed = 1
-  else:
-    errors_allowed = 0
-  # Collect correctly recalled words:
-  hits = []
+  def __init__(self, items, max_distance=1):
+    self.max_distance = max_distance
+    self.items = list(dict.fromkeys(items))
+    self.buckets = {}
+    for n, w in enumerate(self.items):
+      for d in deletion_neighbourhood(w, max_distance):
+        self.buckets.setdefault(d, []).append(n)
+
+  def __contains__(self, w):
+    return w in self.buckets and any(self.items[n] == w for n in self.buckets[w])
+
+  def query(self, w, max_distance=None):
+    """
+    Returns a list of (item, distance) pairs for all indexed items
+    within max_distance of w, closest first.
+    """
+    if max_distance is None:
+      max_distance = self.max_distance
+    if max_distance > self.max_distance:
+      raise ValueError("The index only supports distances up to %d." % self.max_distance)
+    candidates = set()
+    for d in deletion_neighbourhood(w, max_distance):
+      candidates.update(self.buckets.get(d, ()))
+    result = []
+    for n in sorted(candidates):
+      dist = word_distance(w, self.items[n], max_distance)
+      if dist <= max_distance:
+        result.append((self.items[n], dist))
+    result.sort(key=lambda x:x[1])
+    return result
+
+  def similar_pairs(self, max_distance=None):
+    """
+    Returns a list of (item1, item2, distance) triples for all pairs
+    of indexed items that are within max_distance of each other.
+    """
+    if max_distance is None:
+      max_distance = self.max_distance
+    checked = set()
+    pairs = []
+    for bucket in self.buckets.values():
+      for a in range(len(bucket)):
+        for b in range(a+1, len(bucket)):
+          pair = (bucket[a], bucket[b])
+          if pair in checked:
+            continue
+          checked.add(pair)
+          dist = word_distance(self.items[pair[0]], self.items[pair[1]], max_distance)
+          if dist <= max_distance:
+            pairs.append((pair[0], pair[1], dist))
+    pairs.sort()
+    return [(self.items[a], self.items[b], dist) for a, b, dist in pairs]
+
+def match_table(s, t, errors_allowed, index=None, distance=None):
+  """
+  Compares each response in s with the targets in t.  Returns a list
+  with one entry per response containing (position in t, distance)
+  pairs for all targets within errors_allowed of that response.
+  """
+  if not distance:
+    distance = word_distance
+  # An index over the target pool can only be used if it covers all
+  # targets and the number of tolerated errors:
+  if (index is not None and errors_allowed > 0
+      and index.max_distance >= errors_allowed
+      and all(w in index for w in t)):
+    positions = {}
+    for n, w2 in enumerate(t):
+      positions.setdefault(w2, []).append(n)
+    return [sorted((n, dist) for w2, dist in index.query(w1, errors_allowed)
+                   for n in positions.get(w2, ()))
+            for w1 in s]
+  table = []
   for w1 in s:
-    for w2 in t:
-      if damerau_levenshtein(w1,w2) <= errors_allowed:
-        hits.append(w2)
-        continue
+    row = []
+    for n, w2 in enumerate(t):
+      dist = distance(w1, w2, errors_allowed)
+      if dist <= errors_allowed:
+        row.append((n, dist))
+    table.append(row)
+  return table
+
+def optimal_assignment(cost):
+  """
+  Solves the assignment problem for a rectangular cost matrix (given
+  as a list of rows) using the Hungarian algorithm.  Returns a list of
+  (row, column) pairs with minimal total cost in which every row or
+  every column (whichever are fewer) is used exactly once.
+  """
+  if not cost or not cost[0]:
+    return []
+  n = len(cost)
+  m = len(cost[0])
+  if n > m:
+    transposed = [[cost[i][j] for i in range(n)] for j in range(m)]
+    return sorted((i, j) for j, i in optimal_assignment(transposed))
+  inf = float("inf")
+  u = [0] * (n + 1)
+  v = [0] * (m + 1)
+  p = [0] * (m + 1)    # row assigned to each column, 1-based
+  way = [0] * (m + 1)
+  for i in range(1, n + 1):
+    p[0] = i
+    j0 = 0
+    minv = [inf] * (m + 1)
+    used = [False] * (m + 1)
+    while True:
+      used[j0] = True
+      i0 = p[j0]
+      delta = inf
+      j1 = 0
+      for j in range(1, m + 1):
+        if not used[j]:
+          cur = cost[i0-1][j-1] - u[i0] - v[j]
+          if cur < minv[j]:
+            minv[j] = cur
+            way[j] = j0
+          if minv[j] < delta:
+            delta = minv[j]
+            j1 = j
+      for j in range(m + 1):
+        if used[j]:
+          u[p[j]] += delta
+          v[j] -= delta
+        else:
+          minv[j] -= delta
+      j0 = j1
+      if p[j0] == 0:
+        break
+    while j0:
+      j1 = way[j0]
+      p[j0] = p[j1]
+      j0 = j1
+  return sorted((p[j] - 1, j - 1) for j in range(1, m + 1) if p[j])
+
+def score_table(table, t, heed_order, errors_allowed, optimal_matching=False):
+  """
+  Scores a trial given the match table of its responses (see
+  match_table).  Returns the number of correctly recalled targets and
+  the list of recalled targets in the order in which they were
+  entered.
+  """
+  if optimal_matching:
+    # Each response is credited to at most one target and vice versa.
+    # The assignment maximizes the number of matched pairs first and
+    # minimizes the number of typos second:
+    unmatched = errors_allowed * min(len(table), len(t)) + 1
+    cost = [[unmatched] * len(t) for row in table]
+    for i, row in enumerate(table):
+      for n, dist in row:
+        cost[i][n] = dist
+    # Positions of the matched targets in the order of the responses:
+    recalled = [n for i, n in optimal_assignment(cost) if cost[i][n] < unmatched]
+    hits = [t[n] for n in recalled]
+    if heed_order:
+      return len(t) - damerau_levenshtein(recalled, range(len(t)),
+                                          transpositions=False), hits
+    return len(recalled), hits
+
+  # Collect correctly recalled words:
+  hits = [t[n] for row in table for n, dist in row]
   # Remove duplicates from list of hits (although duplicates should
   # not occur when the experiment is properly configured):
   seen = set()
@@ -63,16 +319,369 @@ def calculate_score(s, t, allow_sloppy_spelling, heed_order):
   hits = [x for x in hits if not (x in seen or seen_add(x))]
 
   if heed_order:
-    # Subtract points for items recalled in incorrect order:
-    correct = len(t) - damerau_levenshtein(hits, t)
+    # Subtract points for items recalled in incorrect order.  Swapped
+    # items are both in the wrong position, so transpositions must not
+    # count as a single edit here:
+    correct = len(t) - damerau_levenshtein(hits, t, transpositions=False)
   else:
     correct = len(hits)
 
-  return correct
+  return correct, hits
+
+def calculate_score(s, t, allow_sloppy_spelling, heed_order, errors_allowed=1,
+                    index=None, optimal_matching=False, distance=None):
+  # Allow errors_allowed typos: omission, addition, substitution of a
+  # character, or transposition of two characters.
+  if not allow_sloppy_spelling:
+    errors_allowed = 0
+  table = match_table(s, t, errors_allowed, index, distance)
+  return score_table(table, t, heed_order, errors_allowed, optimal_matching)[0]
+
+# The four combinations of allow_sloppy_spelling and heed_order:
+scoring_policies = [(False, False), (False, True), (True, False), (True, True)]
+
+def score_variants(s, t, errors_allowed=1, index=None, optimal_matching=False,
+                   distance=None):
+  """
+  Scores a trial under all combinations of allow_sloppy_spelling and
+  heed_order while comparing responses and targets only once.
+  Returns a dictionary with the scores (keyed by (allow_sloppy_spelling,
+  heed_order) tuples) and the lists of targets recalled without typos
+  (strict_hits) and with up to errors_allowed typos (lenient_hits).
+  """
+  lenient = match_table(s, t, errors_allowed, index, distance)
+  strict = [[(n, dist) for n, dist in row if dist == 0] for row in lenient]
+  scores = {}
+  hits = {}
+  for sloppy, heed_order in scoring_policies:
+    if sloppy:
+      table, k = lenient, errors_allowed
+    else:
+      table, k = strict, 0
+    scores[(sloppy, heed_order)], hits[sloppy] = score_table(
+      table, t, heed_order, k, optimal_matching)
+  return {"scores":scores, "strict_hits":hits[False],
+          "lenient_hits":hits[True]}
+
+def variant_column(policy):
+  """
+  Name of the results column holding the score under the given
+  (allow_sloppy_spelling, heed_order) policy.
+  """
+  return "correctly.recalled.%s.%s" % (("exact", "sloppy")[policy[0]],
+                                       ("unordered", "ordered")[policy[1]])
+
+def format_score(x):
+  """
+  Formats a score for the results file.  Missing scores (None) are
+  written as NA.
+  """
+  return "NA" if x is None else "%.3f" % x
+
+def pcu_variant_line(policy, pcu):
+  """
+  Comment line reporting the PCU score under the given policy (NA if
+  pcu is None).
+  """
+  return ("# Partial credit unit score (PCU) with allow_sloppy_spelling %s and heed_order %s: %s"
+          % (policy[0], policy[1], format_score(pcu)))
+
+class LRUCache(object):
+  """
+  A dictionary of bounded size that forgets the least recently used
+  entries first and counts hits and misses.
+  """
+
+  def __init__(self, maxsize=4096):
+    if maxsize < 1:
+      raise ValueError("The size of a cache must be at least 1.")
+    self.maxsize = maxsize
+    self.data = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.data)
+
+  def lookup(self, key, compute):
+    """
+    Returns the value stored for key.  If there is none, it is
+    computed by calling compute() and stored.
+    """
+    try:
+      value = self.data[key]
+    except KeyError:
+      self.misses += 1
+      value = self.data[key] = compute()
+      if len(self.data) > self.maxsize:
+        self.data.popitem(last=False)
+      return value
+    self.hits += 1
+    self.data.move_to_end(key)
+    return value
+
+  def clear(self):
+    self.data.clear()
+    self.hits = 0
+    self.misses = 0
+
+def normalize_item(w):
+  """
+  Normalizes a response or target the way it is compared during
+  scoring.
+  """
+  return w.strip().lower()
+
+class ScoreCache(object):
+  """
+  Memoizes distances and scores across many trials, e.g., when the
+  protocols of a whole cohort are rescored.  Items are normalized
+  before they are looked up, so that results can be shared between
+  protocols that differ only in case or whitespace.
+  """
+
+  def __init__(self, maxsize=4096):
+    self.distances = LRUCache(maxsize)
+    self.scores = LRUCache(maxsize)
+
+  def distance(self, w1, w2, max_distance=None):
+    w1 = normalize_item(w1)
+    w2 = normalize_item(w2)
+    return self.distances.lookup((w1, w2, max_distance),
+                                 lambda:word_distance(w1, w2, max_distance))
+
+  def score(self, s, t, allow_sloppy_spelling, heed_order, errors_allowed=1,
+            index=None, optimal_matching=False):
+    s = tuple(normalize_item(w) for w in s)
+    t = tuple(normalize_item(w) for w in t)
+    if not allow_sloppy_spelling:
+      errors_allowed = 0
+    key = (s, t, errors_allowed, bool(heed_order), bool(optimal_matching))
+    return self.scores.lookup(key, lambda:calculate_score(
+      s, t, allow_sloppy_spelling, heed_order, errors_allowed, index,
+      optimal_matching, self.distance))
+
+  def info(self):
+    """
+    Returns a dictionary with hit and miss counts and current sizes.
+    """
+    return {"distance_hits":self.distances.hits,
+            "distance_misses":self.distances.misses,
+            "distance_size":len(self.distances),
+            "score_hits":self.scores.hits,
+            "score_misses":self.scores.misses,
+            "score_size":len(self.scores),
+            "maxsize":self.distances.maxsize}
+
+  def clear(self):
+    self.distances.clear()
+    self.scores.clear()
+
+ns_per_ms = 1000000
+
+class EventClock(object):
+  """
+  Translates the timestamps of keyboard events (milliseconds on the
+  clock of the window system) to the clock used for timing trials.
+  The offset between both clocks is estimated as the smallest
+  difference observed so far, i.e. from the event that was handled
+  most quickly.  Timestamps wrap around after 2**32 milliseconds.
+  """
+
+  wrap = 2**32 * ns_per_ms
+
+  def __init__(self, clock):
+    self.clock = clock
+    self.offset = None
+
+  def align(self, event_ms):
+    """
+    Returns the time of the event on the trial clock and the time that
+    passed until it was handled, both in ns.  Without an event
+    timestamp, the current time and None are returned.
+    """
+    now = self.clock()
+    # Tkinter reports "??" when an event has no timestamp:
+    if not isinstance(event_ms, int) or not event_ms:
+      return now, None
+    offset = now - event_ms * ns_per_ms
+    if self.offset is not None and offset - self.offset > self.wrap // 2:
+      # The timestamps of the window system have wrapped around:
+      self.offset += self.wrap
+    if self.offset is None or offset < self.offset:
+      self.offset = offset
+    event_time = event_ms * ns_per_ms + self.offset
+    return event_time, now - event_time
+
+def lag_statistics(lags):
+  """
+  Returns the mean, the 95th percentile, and the maximum of a list of
+  lags in ns (None for an empty list).
+  """
+  if not lags:
+    return None
+  lags = sorted(lags)
+  return (int(mean(lags)), lags[int(math.ceil(0.95 * len(lags))) - 1], lags[-1])
+
+class LagMonitor(object):
+  """
+  Records how late callbacks scheduled with after fire compared to the
+  time for which they were scheduled.  The statistics of each trial are
+  written to sink (if given) as one line; those of the whole session
+  are available through session_lines.
+  """
+
+  columns = ["phase", "set.id", "callbacks", "mean.lag.ns", "p95.lag.ns",
+             "max.lag.ns"]
+
+  def __init__(self, sink=None):
+    self.sink = sink
+    self.trial = []
+    self.session = []
+    if sink:
+      sink.write_line("\t".join(self.columns))
+      sink.end_trial()
+
+  def record(self, lag):
+    self.trial.append(lag)
+    self.session.append(lag)
+
+  def start_trial(self):
+    self.trial = []
+
+  def end_trial(self, phase, set_no):
+    stats = lag_statistics(self.trial)
+    if self.sink and stats:
+      self.sink.write_line("%s\t%d\t%d\t%d\t%d\t%d"
+                           % ((phase, set_no, len(self.trial)) + stats))
+      self.sink.end_trial()
+    self.trial = []
+
+  def session_lines(self):
+    """
+    Comment lines summarizing the lags of the whole session.
+    """
+    stats = lag_statistics(self.session)
+    if not stats:
+      return []
+    return (["# after_callbacks = %d" % len(self.session)]
+            + ["# after_lag_%s_ns = %d" % (name, x)
+               for name, x in zip(["mean", "p95", "max"], stats)])
+
+class DispatchProfiler(object):
+  """
+  Measures how long the handlers of key presses and scheduled
+  callbacks take.  Times are attributed to the name of the handler
+  (e.g. TestScript.store_results) and collected in a histogram with
+  decadic bins.
+  """
+
+  # Upper bounds of the bins in ns; the last bin is open:
+  bins = [10000, 100000, 1000000, 10000000, 100000000]
+  bin_names = ["<10us", "<100us", "<1ms", "<10ms", "<100ms", ">=100ms"]
+
+  def __init__(self, clock=time.perf_counter_ns):
+    self.clock = clock
+    self.handlers = {}            # name -> [calls, total, max, histogram]
+
+  def call(self, func, *args, **kwargs):
+    start = self.clock()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      self.record(self.name(func), self.clock() - start)
+
+  @staticmethod
+  def name(func):
+    """
+    The name of a handler.  Methods are named after the class of their
+    object, partial applications after the wrapped function.
+    """
+    while isinstance(func, functools.partial):
+      func = func.func
+    if hasattr(func, "__func__"):
+      return "%s.%s" % (type(func.__self__).__name__, func.__name__)
+    return getattr(func, "__qualname__", repr(func))
+
+  def record(self, name, duration):
+    if name not in self.handlers:
+      self.handlers[name] = [0, 0, 0, [0] * len(self.bin_names)]
+    stats = self.handlers[name]
+    stats[0] += 1
+    stats[1] += duration
+    stats[2] = max(stats[2], duration)
+    i = 0
+    while i < len(self.bins) and duration >= self.bins[i]:
+      i += 1
+    stats[3][i] += 1
+
+  def lines(self):
+    """
+    The histogram as lines of a tab-separated table, handlers with the
+    largest total time first.
+    """
+    lines = ["\t".join(["handler", "calls", "total.ns", "mean.ns", "max.ns"]
+                       + self.bin_names)]
+    for name, (calls, total, longest, histogram) in sorted(
+        self.handlers.items(), key=lambda x:-x[1][1]):
+      lines.append("\t".join([name, "%d" % calls, "%d" % total, "%d" % (total // calls),
+                              "%d" % longest] + ["%d" % n for n in histogram]))
+    return lines
+
+def profiled(profiler, func, *args, **kwargs):
+  """
+  Calls func, through profiler if there is one.
+  """
+  if profiler is None:
+    return func(*args, **kwargs)
+  return profiler.call(func, *args, **kwargs)
+
+def detect_refresh_rate():
+  """
+  Asks the operating system for the refresh rate of the display (in
+  Hz).  Returns None if it cannot be determined.  On X11, this needs
+  the program xrandr.
+  """
+  if sys.platform == "win32":
+    import ctypes
+    dc = ctypes.windll.user32.GetDC(0)
+    try:
+      rate = ctypes.windll.gdi32.GetDeviceCaps(dc, 116)  # VREFRESH
+    finally:
+      ctypes.windll.user32.ReleaseDC(0, dc)
+    # 0 and 1 stand for the default refresh rate of the hardware:
+    return float(rate) if rate > 1 else None
+  try:
+    output = subprocess.run(["xrandr", "--current"], capture_output=True,
+                            text=True, timeout=5).stdout
+  except (OSError, subprocess.SubprocessError):
+    return None
+  # The current mode is marked with an asterisk, e.g. "60.00*+":
+  mo = re.search(r"(\d+\.\d+)\*", output)
+  return float(mo.group(1)) if mo else None
+
+def frame_duration(ms, refresh_rate):
+  """
+  Rounds a duration in milliseconds to a whole number of frames (at
+  least one).  Returns the number of frames and the rounded duration.
+  """
+  frames = max(1, int(round(ms * refresh_rate / 1000.0)))
+  return frames, frames * 1000.0 / refresh_rate
 
 class MainFrame(tkinter.Frame):
 
-  def __init__(self, master, *scripts, **opts):
+  # All timestamps are integer nanoseconds from a monotonic clock.  The
+  # clock can be replaced, e.g. by a virtual clock for simulations:
+  clock = staticmethod(time.perf_counter_ns)
+
+  # Time before a deadline that is spent polling the clock instead of
+  # waiting for a less precise timer (in ns):
+  spin = 2 * ns_per_ms
+
+  # Number of laid out texts that are kept:
+  stimulus_cache_size = 64
+
+  def __init__(self, master, *scripts, lags=None, profiler=None, **opts):
 
     # build gui:
     tkinter.Frame.__init__(self, master, **opts)
@@ -80,26 +689,33 @@ class MainFrame(tkinter.Frame):
 
     self.scripts = list(scripts)
     self.opts = {}
+    self.event_clock = EventClock(self.clock)
+    self.lags = lags or LagMonitor()
+    self.profiler = profiler
 
-    self.display_var = tkinter.StringVar(self, "")
+    # Texts are laid out as hidden canvas items before they are needed,
+    # so that showing them only changes which item is visible:
     width = master.winfo_screenwidth()
-    self.display = tkinter.Message(self, justify=LEFT, textvar=self.display_var,
-                     font=(fontname, fontsize),
-                     width=width-(width/10), bg="white")
+    self.wrap_width = width-(width/10)
+    self.display = tkinter.Canvas(self, bg="white", highlightthickness=0)
     self.display.pack(fill=BOTH, expand=1)
+    self.display.bind('<Configure>', self.center_stimuli)
+    self.justify = LEFT
+    self.stimuli = OrderedDict()  # (text, justify) -> canvas item
+    self.shown = None
 
     self.entry_var = tkinter.StringVar(self, "")
     self.entry = tkinter.Entry(self, font=(fontname, fontsize),
                                state="disabled",
                                textvar=self.entry_var)
     self.entry.pack(fill=X)
-    self.entry.bind('<Return>', lambda e:self.key_pressed('<Return>'))
+    self.entry.bind('<Return>', lambda e:self.key_pressed('<Return>', e))
 
-    self.bind('<space>', lambda e:self.key_pressed('<space>'))
+    self.bind('<space>', lambda e:self.key_pressed('<space>', e))
 
     # Sometimes lexical closures suck:
     def event_handler_creator(frame, key):
-      return lambda e:frame.key_pressed(key)
+      return lambda e:frame.key_pressed(key, e)
 
     for v in responses.values():
       self.bind(v, event_handler_creator(self, v))
@@ -108,20 +724,215 @@ class MainFrame(tkinter.Frame):
 
     self.key_pressed(None)
 
-  def key_pressed(self, key):
+  def key_pressed(self, key, event=None):
+    # When the key was pressed and how long it took until it was
+    # handled:
+    self.key_time, self.key_delay = self.event_clock.align(getattr(event, "time", None))
     if self.scripts:
-      self.scripts[0].next(self, key, **self.opts)
+      profiled(self.profiler, self.scripts[0].next, self, key, **self.opts)
     else:
       sys.exit(0)
 
+  def at(self, deadline, func, *args):
+    """
+    Calls func when the clock reaches deadline (in ns).  Tk's timers
+    are used to wait until shortly before the deadline; the rest is
+    spent polling the clock.  Records how late func is called.  Returns
+    an id for after_cancel.
+    """
+    def callback(*args):
+      while self.clock() < deadline:
+        pass
+      self.lags.record(self.clock() - deadline)
+      profiled(self.profiler, func, *args)
+    ms = max(0, (deadline - self.clock() - self.spin) // ns_per_ms)
+    return self.after(ms, callback, *args)
+
   def next_script(self, **opts):
     self.opts.update(opts)
     self.scripts.pop(0)
 
+  def center_stimuli(self, event):
+    for item in self.display.find_withtag("stimulus"):
+      self.display.coords(item, event.width/2, event.height/2)
+
+  def stimulus(self, text, justify):
+    """
+    Returns the canvas item showing text, creating it if necessary.
+    Only the stimulus_cache_size most recently used items are kept.
+    """
+    key = (text, justify)
+    if key in self.stimuli:
+      self.stimuli.move_to_end(key)
+      return self.stimuli[key]
+    item = self.stimuli[key] = self.display.create_text(
+      self.display.winfo_width()/2, self.display.winfo_height()/2,
+      text=text, justify=justify, width=self.wrap_width,
+      font=(fontname, fontsize), state=HIDDEN, tags="stimulus")
+    if len(self.stimuli) > self.stimulus_cache_size:
+      old_key, old_item = self.stimuli.popitem(last=False)
+      if old_item == self.shown:
+        self.stimuli[old_key] = old_item
+      else:
+        self.display.delete(old_item)
+    return item
+
+  def prepare(self, texts, justify=None):
+    """
+    Lays out texts that will be shown soon.
+    """
+    for text in texts:
+      self.stimulus(text, justify or self.justify)
+    self.update_idletasks()
+
   def set_text(self, text, justify=None):
+    """
+    Shows text and returns the time at which the display was updated.
+    """
     if justify:
-        self.display["justify"] = justify
-    self.display_var.set(text)
+        self.justify = justify
+    item = self.stimulus(text, self.justify)
+    if item != self.shown:
+      if self.shown is not None:
+        self.display.itemconfigure(self.shown, state=HIDDEN)
+      self.display.itemconfigure(item, state=NORMAL)
+      self.shown = item
+    self.update_idletasks()
+    return self.clock()
+
+class HeadlessFrame(object):
+  """
+  Runs scripts without a display.  Time is simulated: callbacks
+  scheduled with after or at are only called when the clock is
+  advanced (see advance, step, and run), so a whole session takes
+  milliseconds.  Use press to simulate key presses and entry_var to
+  enter responses.  The module settings must have been set with
+  configure.
+  """
+
+  def __init__(self, *scripts, lags=None, profiler=None):
+    self.scripts = list(scripts)
+    self.opts = {}
+    self.now = 0
+    self.queue = []               # heap of (deadline, id)
+    self.pending = {}             # id -> (func, args)
+    self.next_id = 0
+    self.lags = lags or LagMonitor()
+    self.profiler = profiler
+    self.text = ""
+    self.justify = LEFT
+    self.entry_var = HeadlessVariable()
+    self.entry = HeadlessWidget()
+    self.key_pressed(None)
+
+  def clock(self):
+    return self.now
+
+  def key_pressed(self, key, event=None):
+    self.key_time, self.key_delay = self.now, 0
+    if self.scripts:
+      profiled(self.profiler, self.scripts[0].next, self, key, **self.opts)
+
+  def press(self, key, ms=0):
+    """
+    Advances the clock by ms and presses key.
+    """
+    self.advance(ms)
+    self.key_pressed(key)
+
+  def next_script(self, **opts):
+    self.opts.update(opts)
+    self.scripts.pop(0)
+
+  def after(self, ms, func, *args):
+    return self.at(self.now + int(ms * ns_per_ms), func, *args)
+
+  def at(self, deadline, func, *args):
+    self.next_id += 1
+    self.pending[self.next_id] = (func, args)
+    heapq.heappush(self.queue, (deadline, self.next_id))
+    return self.next_id
+
+  def after_cancel(self, id):
+    self.pending.pop(id, None)
+
+  def advance(self, ms):
+    """
+    Advances the clock by ms and calls the callbacks that are due.
+    """
+    self.advance_to(self.now + int(ms * ns_per_ms))
+
+  def advance_to(self, until):
+    """
+    Advances the clock to until (in ns) and calls the callbacks that
+    are due.
+    """
+    while self.queue and self.queue[0][0] <= until:
+      deadline, id = heapq.heappop(self.queue)
+      if id in self.pending:
+        func, args = self.pending.pop(id)
+        self.now = max(self.now, deadline)
+        self.lags.record(self.now - deadline)
+        profiled(self.profiler, func, *args)
+    self.now = until
+
+  def step(self):
+    """
+    Advances the clock to the next scheduled callback and calls it.
+    """
+    while self.queue and self.queue[0][1] not in self.pending:
+      heapq.heappop(self.queue)
+    if self.queue:
+      self.advance_to(max(self.now, self.queue[0][0]))
+
+  def run(self):
+    """
+    Calls all scheduled callbacks, including those scheduled by them,
+    and advances the clock accordingly.
+    """
+    while self.pending:
+      self.step()
+
+  def set_text(self, text, justify=None):
+    if justify:
+      self.justify = justify
+    self.text = text
+    return self.now
+
+  def prepare(self, texts, justify=None):
+    pass
+
+  def focus_set(self):
+    pass
+
+class HeadlessVariable(object):
+  """
+  Stands in for tkinter.StringVar in HeadlessFrame.
+  """
+
+  def __init__(self, value=""):
+    self.value = value
+
+  def get(self):
+    return self.value
+
+  def set(self, value):
+    self.value = value
+
+class HeadlessWidget(object):
+  """
+  Stands in for the entry field in HeadlessFrame.
+  """
+
+  def __init__(self):
+    self.state = "disabled"
+
+  def focus_set(self):
+    pass
+
+  def configure(self, state=None, **opts):
+    if state:
+      self.state = state
 
 class Text(object):
 
@@ -136,21 +947,24 @@ class Text(object):
 class PracticeProcessingItemsScript(object):
 
   def __init__(self, processing_items):
-    self.processing_items = processing_items
+    self.processing_items = list(processing_items)
 
     # Data strctures for collecting the results:
     self.number = 0
     self.correct = 0
-    self.times = []
+    self.last_time = None         # when the previous element was shown
+    self.estimator = new_time_out_estimator()
 
     self.next = self.show_element
 
   def show_element(self, frame, key=None, **opts):
     if key != None and key != "<space>":
       return
-    element, self.desired_answer = [s.strip() for s in next(self.processing_items).split('\t')]
-    self.times.append(time.time())
-    frame.set_text(element)
+    if self.number == 0:
+      frame.prepare([element for element, answer in self.processing_items]
+                    + [practice_correct_response, practice_incorrect_response])
+    element, self.desired_answer = self.processing_items[self.number]
+    self.record_time(frame.set_text(element))
     self.number += 1
     self.next = self.store_results
 
@@ -160,94 +974,129 @@ class PracticeProcessingItemsScript(object):
     self.next = lambda s,f,**o:None
     if key == responses[self.desired_answer]:
       self.correct += 1
-      frame.set_text(practice_correct_response)
+      shown = frame.set_text(practice_correct_response)
     else:
-      frame.set_text(practice_incorrect_response)
+      shown = frame.set_text(practice_incorrect_response)
+    deadline = shown + int(response_display_time * ns_per_ms)
     if self.number == practice_processing_items:
-      frame.after(response_display_time, lambda:self.show_results(frame, **opts))
+      frame.at(deadline, functools.partial(self.show_results, frame, **opts))
     else:
-      frame.after(response_display_time, lambda:self.show_element(frame, **opts))
+      frame.at(deadline, functools.partial(self.show_element, frame, **opts))
+
+  def record_time(self, t):
+    # The time needed for an element is the interval until the next
+    # element is shown.  The first measure_time_after_trial elements
+    # are not used:
+    if self.number > measure_time_after_trial:
+      self.estimator.add(t - self.last_time)
+    self.last_time = t
 
   def show_results(self, frame, **opts):
-    self.times.append(time.time())
+    self.record_time(frame.clock())
 
     frame.set_text(practice_summary % {
       "total":practice_processing_items,
       "correct":self.correct})
 
-    time_out = int(1000 * (mean(diff(self.times[measure_time_after_trial:]))
-          + time_out_factor * sd(diff(self.times[measure_time_after_trial:]))))
-
-    frame.next_script(time_out=time_out, **opts)
+    frame.next_script(time_out=self.estimator.time_out(time_out_factor),
+                      estimator=self.estimator, **opts)
 
 class TestScript(object):
 
-  def __init__(self, processing_items, target_items, levels, items_per_level,
-               phase):
+  def __init__(self, sets, phase, sink):
 
-    self.processing_items = processing_items
-    self.target_items = target_items
+    # Each set is a list of (processing item, answer, target) triples:
+    self.sets = list(sets)
     self.phase = phase
+    self.sink = sink              # receives a line for each completed set
 
-    self.sets = list(levels * items_per_level)
-    random.shuffle(self.sets)
-
-    self.cur, self.cur_targets = self.next_set()
+    self.cur = self.next_set()
 
     # Data structures for collecting the results:
     self.set_no = 1
     self.correct = 0              # number of correctly verifies processing items
-    self.times = []
+    self.times = []               # response times in ns
+    self.onsets = []              # when the display was asked to show an element
+    self.displayed = []           # when the display was updated
+    self.responses = []           # when a key was pressed (None for time-outs)
+    self.delays = []              # time from key press to its handling
+    self.time_outs = []           # time-out of each element in ms
     self.level = len(self.cur)
     self.seen_targets = []
-    self.results = []             # list of lines for the results file
-    self.proportion_recalled = [] # proportion of correctly recalled items
+    self.proportion_recalled = 0.0 # sum of proportions of correctly recalled items
+    self.variant_proportions = dict((p, 0.0) for p in scored_policies)
 
     self.next = self.show_element
 
   def next_set(self):
-    size = self.sets.pop()
-    return [next(self.processing_items) for x in range(size)], self.target_items.get_set(size)
+    return list(self.sets.pop(0))
 
-  def show_element(self, frame, key=None, time_out=None, **opts):
+  def show_element(self, frame, key=None, time_out=None, estimator=None, **opts):
     if key != None and key != "<space>":
       return
-    opts.update({"time_out":time_out})
-    element, self.desired_answer = self.cur.pop(0).split('\t')
-    self.start_time = time.time()
-    frame.set_text(element)
-    self.after_id = frame.after(time_out, lambda:self.interrupt(frame, **opts))
+    if adaptive_time_out and self.phase == "test" and estimator:
+      time_out = estimator.time_out(time_out_factor)
+    opts.update({"time_out":time_out, "estimator":estimator})
+    if not self.onsets:
+      frame.lags.start_trial()
+      self.prepare_set(frame)
+    element, self.desired_answer, self.target = self.cur.pop(0)
+    self.onsets.append(frame.clock())
+    self.start_time = frame.set_text(element)
+    self.displayed.append(self.start_time)
+    self.time_outs.append(time_out)
+    self.deadline = self.start_time + time_out * ns_per_ms
+    self.after_id = frame.at(self.deadline, functools.partial(self.interrupt, frame, **opts))
     self.next = self.show_target
 
-  def interrupt(self, frame, **opts):
+  def interrupt(self, frame, estimator=None, **opts):
     self.next = lambda s,f,**o:None
+    self.times.append(frame.clock() - self.start_time)
+    if adaptive_time_out and self.phase == "test" and estimator:
+      # The response time is at least the time-out:
+      estimator.add(self.deadline - self.start_time
+                    + int(response_display_time * ns_per_ms))
+    opts["estimator"] = estimator
+    self.responses.append(None)
+    self.delays.append(None)
     frame.set_text(time_out_message)
-    self.times.append(time.time() - self.start_time)
-    ti = next(self.cur_targets)
-    self.seen_targets.append(ti)
-    if not self.cur:
-      frame.after(target_display_time, lambda:self.finish_set(frame, **opts))
-    else:
-      frame.after(target_display_time, lambda:self.show_element(frame, **opts))
+    self.seen_targets.append(self.target)
+    # Planned from the deadline of the time-out, so that a late
+    # time-out does not delay the rest of the set:
+    self.next_element(frame, self.deadline + int(target_display_time * ns_per_ms), **opts)
 
-  def show_target(self, frame, key, **opts):
+  def show_target(self, frame, key, estimator=None, **opts):
     if key not in responses.values():
       return
     frame.after_cancel(self.after_id)
     self.next = lambda s,f,**o:None
-    self.times.append(time.time() - self.start_time)
+    self.times.append(frame.key_time - self.start_time)
+    if adaptive_time_out and self.phase == "test" and estimator:
+      # In the practice phase, the feedback was shown for
+      # response_display_time before the next element appeared:
+      estimator.add(self.times[-1] + int(response_display_time * ns_per_ms))
+    opts["estimator"] = estimator
+    self.responses.append(frame.key_time)
+    self.delays.append(frame.key_delay)
     if key == responses[self.desired_answer]:
       self.correct += 1
-    ti = next(self.cur_targets)
-    self.seen_targets.append(ti)
-    frame.set_text(ti)
+    self.seen_targets.append(self.target)
+    shown = frame.set_text(self.target)
+    self.next_element(frame, shown + int(target_display_time * ns_per_ms), **opts)
+
+  def next_element(self, frame, deadline, **opts):
     if not self.cur:
-      frame.after(target_display_time, lambda:self.finish_set(frame, **opts))
+      frame.at(deadline, functools.partial(self.finish_set, frame, **opts))
     else:
-      frame.after(target_display_time, lambda:self.show_element(frame, **opts))
+      frame.at(deadline, functools.partial(self.show_element, frame, **opts))
+
+  def prepare_set(self, frame):
+    frame.prepare([x for element, answer, target in self.cur for x in (element, target)]
+                  + [time_out_message])
 
   def prepare_for_element(self, frame, **opts):
     frame.set_text(next_message)
+    self.prepare_set(frame)
     self.next = self.show_element
 
   def finish_set(self, frame, **opts):
@@ -269,41 +1118,55 @@ class TestScript(object):
 
     t = [x.lower() for x in self.seen_targets]
 
-    recalled = calculate_score(s, t, allow_sloppy_spelling, heed_order)
+    # Score under all policies; the configured one goes into the table:
+    variants = score_variants(s, t, errors_allowed, target_index,
+                              optimal_matching)["scores"]
+    recalled = variants[(bool(allow_sloppy_spelling), bool(heed_order))]
 
-    self.proportion_recalled.append(float(recalled) / float(self.level))
+    self.proportion_recalled += float(recalled) / float(self.level)
+    for p in self.variant_proportions:
+      self.variant_proportions[p] += float(variants[p]) / float(self.level)
 
     print("trial:", self.phase, self.set_no)
     print("  presented:", ", ".join(t))
     print("  entered:", ", ".join(s))
     print("  correct:", recalled, "out of", self.level)
 
-    self.results.append("%s\t%d\t%d\t%d\t%d\t%d\t%d\t%s\t%s"
-                        % (self.phase, self.set_no, self.level, recalled,
-                           self.correct, int(1000*mean(self.times)),
-                           int(1000*max(self.times)), " ".join(t), " ".join(s)))
+    # Write the set to disk right away, so that it survives crashes
+    # and aborted sessions:
+    self.sink.write_line("%s\t%d\t%d\t%d\t%d\t%d\t%d\t%s\t%s\t%s\t%s\t%s\t%s\t%s"
+                         % (self.phase, self.set_no, self.level, recalled,
+                            self.correct, int(mean(self.times) / ns_per_ms),
+                            int(max(self.times) / ns_per_ms), " ".join(t), " ".join(s),
+                            timestamps(self.onsets), timestamps(self.displayed),
+                            timestamps(self.responses), timestamps(self.delays),
+                            " ".join("%d" % x for x in self.time_outs)))
+    self.sink.end_trial()
+    frame.lags.end_trial(self.phase, self.set_no)
 
     try:
-      self.cur, self.cur_targets = self.next_set()
+      self.cur = self.next_set()
       self.set_no += 1
       self.correct = 0
       self.times = []
+      self.onsets = []
+      self.displayed = []
+      self.responses = []
+      self.delays = []
+      self.time_outs = []
       self.level = len(self.cur)
       self.seen_targets = []
       frame.entry_var.set("")
       frame.focus_set()
       frame.entry.configure(state="disabled")
       self.prepare_for_element(frame, **opts)
-    except:
+    except IndexError:
       self.finish(frame, **opts)
 
-  def finish(self, frame, results=None, **opts):
-    if results:
-      results.extend(self.results)
-    else:
-      results = self.results
-    opts.update({"results":results})
-    opts.update({"pcu":mean(self.proportion_recalled)})
+  def finish(self, frame, **opts):
+    # At this point, set_no is the number of completed sets:
+    opts.update({"pcu":self.proportion_recalled / self.set_no})
+    opts.update({"pcu_variants":dict((p, x / self.set_no) for p, x in self.variant_proportions.items())})
     frame.entry_var.set("")
     frame.set_text(finished_message)
     frame.focus_set()
@@ -312,49 +1175,96 @@ class TestScript(object):
 
 class GoodbyeScript(object):
 
+  def __init__(self, sink):
+    self.sink = sink
+
   def next(self, frame, key=None, **opts):
     frame.set_text(good_bye_text)
-    store_line("phase\tset.id\tnum.items\tcorrectly.recalled\tcorrectly.verified\tmean.rt\tmax.rt\tpresented.items\trecalled.items")
-    store_line('\n'.join(opts["results"]))
-    store_line("# Partial credit unit score (PCU): %.3f" % opts["pcu"])
+    self.sink.write_line("# Partial credit unit score (PCU): %.3f" % opts["pcu"])
+    for p in scoring_policies:
+      self.sink.write_line(pcu_variant_line(p, opts["pcu_variants"].get(p)))
+    self.sink.end_trial()
     frame.next_script()
 
-def shuffled_lines(filename):
+class ItemSource(object):
   """
-  Removes duplicate lines, iterates over the lines, shuffles them, and
-  restarts iterating.
+  Base class for the sources from which target and processing items
+  are drawn.  The items that can currently be drawn are kept in a list
+  and each draw takes constant time.  An item is not drawn again
+  before no_repeat other items have been drawn, and items never repeat
+  within a set.  Pass a seeded random.Random as rng to get
+  reproducible draws.
   """
-  lines = list(set([l.strip() for l in open(filename, encoding='utf-8')]))
-  while 1:
-    random.shuffle(lines)
-    for l in lines:
-      yield l
 
-class ShuffledItems:
+  def __init__(self, items, no_repeat=0, rng=None):
+    self.items = list(items)
+    if not self.items:
+      raise ValueError("There are no items to draw from.")
+    self.no_repeat = no_repeat
+    self.rng = rng or random.Random()
+    self.pool = list(self.items)  # items that can be drawn next
+    self.recent = deque()         # items that were drawn recently
 
-  def __init__(self, filename):
-    self.items = shuffled_lines(filename)
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    return self.draw(self.no_repeat)
 
   def get_set(self, size):
-    return (next(self.items) for i in range(size))
+    return iter([self.draw(max(self.no_repeat, i)) for i in range(size)])
+
+  def draw(self, hold):
+    """
+    Draws an item that is not among the hold most recently drawn items.
+    """
+    hold = min(hold, len(self.items) - 1)
+    while len(self.recent) > hold:
+      self.release(self.recent.popleft())
+    if not self.pool:
+      self.refill()
+    i = self.rng.randrange(len(self.pool))
+    item = self.pool[i]
+    self.pool[i] = self.pool[-1]
+    self.pool.pop()
+    self.recent.append(item)
+    return item
+
+  def release(self, item):
+    """
+    Called when an item leaves the window of recently drawn items.
+    """
+    self.pool.append(item)
+
+  def refill(self):
+    raise ValueError("There are too few items to draw from.")
+
+class ShuffledItems(ItemSource):
+  """
+  Presents every item once in random order before items start to
+  repeat.
+  """
 
-class RandomItems:
+  def __init__(self, items, no_repeat=0, rng=None):
+    ItemSource.__init__(self, items, no_repeat, rng)
+    self.pending = set()  # items of the next round that are still held back
 
-  def __init__(self, filename):
-    self.items = list(set([l.decode("utf-8").strip() for l in file(filename)]))
+  def release(self, item):
+    if item in self.pending:
+      self.pending.discard(item)
+      self.pool.append(item)
 
-  def get_set(self, size):
-    return iter(random.sample(self.items, size))
+  def refill(self):
+    # Start a new round; recently drawn items join it when they leave
+    # the window:
+    self.pending = set(self.recent)
+    self.pool = [x for x in self.items if x not in self.pending]
 
-def diff(l):
+class RandomItems(ItemSource):
   """
-  Given a sequence of numbers, this function returns a list containing
-  the differences between each pair of consequtive numers.  If the
-  original sequence has length n, the resulting list will have length
-  n-1.
+  Draws items randomly from all items, so that an item can appear in
+  consecutive sets.
   """
-  n = len(l)
-  return [x-y for x,y in zip(l[1:], l[:n-1])]
 
 def mean(l):
   """
@@ -372,13 +1282,605 @@ def sd(l):
   m = mean(l)
   return math.sqrt(sum([(m-x)**2 for x in l]) / len(l))
 
-def store_line(s, mode='a'):
+def quantile(l, q):
+  """
+  Calculate the q-quantile of a sequence of numbers (interpolating
+  linearly between the closest values).
+  """
+  if len(l) < 1:
+    raise ValueError("The quantiles of an empty list are undefined.")
+  l = sorted(l)
+  i = q * (len(l) - 1)
+  lower = int(math.floor(i))
+  upper = min(lower + 1, len(l) - 1)
+  return l[lower] + (l[upper] - l[lower]) * (i - lower)
+
+class TimeOutEstimator(object):
+  """
+  Base class for estimating the time a participant needs for a
+  processing item from the intervals (in ns) observed so far.
+  Intervals are added one at a time.
+  """
+
+  def time_out(self, factor):
+    """
+    The time-out in ms: the typical interval plus factor times its
+    spread.
+    """
+    center, spread = self.estimate()
+    return int((center + factor * spread) / ns_per_ms)
+
+class MeanSDEstimator(TimeOutEstimator):
+  """
+  Mean and standard deviation, updated in constant time with
+  Welford's algorithm.
+  """
+
+  def __init__(self):
+    self.n = 0
+    self.mean = 0.0
+    self.m2 = 0.0                 # sum of squared deviations from the mean
+
+  def add(self, x):
+    self.n += 1
+    d = x - self.mean
+    self.mean += d / self.n
+    self.m2 += d * (x - self.mean)
+
+  def estimate(self):
+    if self.n < 1:
+      raise ValueError("The time-out cannot be estimated without observations.")
+    return self.mean, math.sqrt(self.m2 / self.n)
+
+class MedianMADEstimator(TimeOutEstimator):
+  """
+  Median and median absolute deviation (scaled to be comparable to a
+  standard deviation), which are not affected by a few outliers.
+  """
+
+  def __init__(self):
+    self.values = []              # kept sorted
+
+  def add(self, x):
+    bisect.insort(self.values, x)
+
+  def estimate(self):
+    if not self.values:
+      raise ValueError("The time-out cannot be estimated without observations.")
+    median = quantile(self.values, 0.5)
+    return median, 1.4826 * quantile([abs(x - median) for x in self.values], 0.5)
+
+class TrimmedEstimator(TimeOutEstimator):
+  """
+  Mean and standard deviation after discarding the proportion trim of
+  the smallest and of the largest intervals.
+  """
+
+  def __init__(self, trim=0.1):
+    self.trim = trim
+    self.values = []              # kept sorted
+
+  def add(self, x):
+    bisect.insort(self.values, x)
+
+  def estimate(self):
+    if not self.values:
+      raise ValueError("The time-out cannot be estimated without observations.")
+    k = int(self.trim * len(self.values))
+    l = self.values[k:len(self.values)-k]
+    return mean(l), sd(l)
+
+time_out_estimators = ["mean_sd", "median_mad", "trimmed"]
+
+def new_time_out_estimator():
+  """
+  Creates the estimator selected with time_out_estimator.
+  """
+  if time_out_estimator == "median_mad":
+    return MedianMADEstimator()
+  if time_out_estimator == "trimmed":
+    return TrimmedEstimator(time_out_trim)
+  return MeanSDEstimator()
+
+# Columns of the table in the results file:
+results_columns = ["phase", "set.id", "num.items", "correctly.recalled",
+                   "correctly.verified", "mean.rt", "max.rt",
+                   "presented.items", "recalled.items",
+                   "onset.ns", "display.ns", "response.ns", "delay.ns",
+                   "time_out.ms"]
+
+def timestamps(l):
+  """
+  Formats a list of nanosecond timestamps for the results file.
+  Missing timestamps (None) are written as NA.
+  """
+  return " ".join("NA" if x is None else "%d" % x for x in l)
+
+class ResultsWriter(object):
+  """
+  Writes the results file through one file handle that stays open for
+  the whole session.  Lines go to a temporary file (the name of the
+  results file plus .part) which replaces the results file when the
+  writer is closed, so the results file is never left half-written.
+  While the session is running, the temporary file serves as a journal:
+  sets are appended as soon as they are completed, so that they survive
+  a crash.
+
+  flush_policy determines when buffered lines are written to disk:
+  "line" (after every line), "trial" (after every trial, see
+  end_trial), "exit" (only when the writer is closed), or an integer
+  N (after every N lines).  With fsync=True, every flush is also
+  committed to the storage device.
+  """
+
+  def __init__(self, filename, flush_policy="trial", fsync=False):
+    if not (flush_policy in ("line", "trial", "exit")
+            or (type(flush_policy) == int and flush_policy > 0)):
+      raise ValueError("Invalid flush policy: %r" % (flush_policy,))
+    self.filename = filename
+    self.partial_filename = filename + ".part"
+    self.flush_policy = flush_policy
+    self.fsync = fsync
+    self.unflushed = 0
+    self.fh = open(self.partial_filename, 'w', encoding='utf-8')
+
+  def write_line(self, s):
+    """
+    Writes the given string plus a newline character.
+    """
+    self.fh.write(s + '\n')
+    self.unflushed += 1
+    if (self.flush_policy == "line"
+        or (type(self.flush_policy) == int and self.unflushed >= self.flush_policy)):
+      self.flush()
+
+  def end_trial(self):
+    """
+    Signals that all lines of a trial have been written.
+    """
+    if self.flush_policy == "trial":
+      self.flush()
+
+  def flush(self):
+    self.fh.flush()
+    if self.fsync:
+      os.fsync(self.fh.fileno())
+    self.unflushed = 0
+
+  def close(self):
+    """
+    Flushes all lines and moves the file to its final name.
+    """
+    if self.fh.closed:
+      return
+    self.fh.flush()
+    os.fsync(self.fh.fileno())
+    self.fh.close()
+    os.replace(self.partial_filename, self.filename)
+
+def read_configuration(config_file):
+  """
+  Executes a configuration file and returns the settings it defines
+  as a dictionary.
+  """
+  settings = {}
+  exec(open(config_file, encoding='utf-8').read(), settings)
+  del settings["__builtins__"]
+  return settings
+
+# Increase when the structure of material bundles changes:
+bundle_version = 1
+
+def read_material_files(target_items_file, processing_items_file):
+  """
+  Reads the material files.  Returns their stripped lines and a hash
+  of their contents.
+  """
+  h = hashlib.sha256()
+  lines = []
+  for filename in (target_items_file, processing_items_file):
+    with open(filename, 'rb') as fh:
+      data = fh.read()
+    h.update(b"%d:" % len(data))
+    h.update(data)
+    lines.append([l.strip() for l in data.decode('utf-8').splitlines()])
+  return lines[0], lines[1], h.hexdigest()
+
+def compile_materials(target_items_file, processing_items_file, errors_allowed=1):
+  """
+  Reads and preprocesses the material files.  Returns a bundle (a
+  dictionary that can be stored as JSON) with the deduplicated target
+  items, the processing items split into (item, answer) pairs, and the
+  information needed for the sanity checks, including the pairs of
+  target items that are too similar for sloppy spelling with the given
+  number of errors.
+  """
+  targets, processing_items, material_hash = read_material_files(
+    target_items_file, processing_items_file)
+  unique_processing_items = list(dict.fromkeys(processing_items))
+  return {
+    "version":bundle_version,
+    "hash":material_hash,
+    "errors_allowed":errors_allowed,
+    "target_count":len(targets),
+    "targets":list(dict.fromkeys(targets)),
+    "target_duplicates":duplicates(targets),
+    "single_letters":all(len(x)==1 for x in targets),
+    "similar_targets":[[a, b] for a, b, dist in
+                       SimilarityIndex(targets, errors_allowed).similar_pairs()],
+    "processing_items":[[s.strip() for s in l.split('\t')]
+                        for l in unique_processing_items],
+    "processing_duplicates":duplicates(processing_items)}
+
+def bundle_filename(config_file):
+  """
+  Name of the file in which the compiled materials of a configuration
+  are stored.
+  """
+  return os.path.splitext(config_file)[0] + ".materials.json"
+
+def write_json(data, filename):
+  """
+  Stores data compactly as JSON.  The file is replaced in one step,
+  so readers never see a partially written file.
+  """
+  tmp = filename + ".part"
+  with open(tmp, 'w', encoding='utf-8') as fh:
+    json.dump(data, fh, ensure_ascii=False, separators=(',', ':'))
+  os.replace(tmp, filename)
+
+def load_materials(target_items_file, processing_items_file, errors_allowed=1,
+                   filename=None):
+  """
+  Returns the compiled materials.  If filename names a bundle that was
+  compiled from the current material files, the bundle is loaded.
+  Otherwise the materials are compiled again and, if filename is
+  given, stored for the next time.
+  """
+  if filename and os.path.exists(filename):
+    try:
+      with open(filename, encoding='utf-8') as fh:
+        bundle = json.load(fh)
+      material_hash = read_material_files(target_items_file, processing_items_file)[2]
+      if (bundle.get("version") == bundle_version
+          and bundle.get("hash") == material_hash
+          and bundle.get("errors_allowed") == errors_allowed):
+        return bundle
+    except ValueError:
+      pass
+  bundle = compile_materials(target_items_file, processing_items_file,
+                             errors_allowed)
+  if filename:
+    try:
+      write_json(bundle, filename)
+    except OSError as e:
+      warn("Could not store compiled materials in %s: %s" % (filename, e))
+  return bundle
+
+def compile_materials_main(argv):
+  """
+  Command line interface for compiling the materials of a task.
+  """
+  parser = argparse.ArgumentParser(
+    prog="%s compile-materials" % os.path.basename(sys.argv[0]),
+    description="Preprocess the material files of a task for fast start-up.")
+  parser.add_argument("task", help="task directory or configuration file")
+  args = parser.parse_args(argv)
+
+  config_file = args.task
+  if os.path.isdir(config_file):
+    config_file = os.path.join(config_file, "configuration.py")
+  settings = read_configuration(config_file)
+  directory = os.path.dirname(config_file)
+  bundle = compile_materials(os.path.join(directory, settings["target_items_file"]),
+                             os.path.join(directory, settings["processing_items_file"]),
+                             settings.get("errors_allowed", 1))
+  filename = bundle_filename(config_file)
+  write_json(bundle, filename)
+  print("%s: %d target items, %d processing items" % (
+    filename, len(bundle["targets"]), len(bundle["processing_items"])))
+  return 0
+
+# Settings that every configuration file must define:
+required_settings = """fontname fontsize processing_items_file target_items_file
+  responses welcome_text instructions1 allow_sloppy_spelling
+  practice_processing_items measure_time_after_trial heed_order
+  pseudo_random_targets practice_levels practice_items_per_level
+  practice_correct_response practice_incorrect_response practice_summary
+  instructions2 instructions3 levels items_per_level next_message
+  finished_message time_out_factor time_out_message target_display_time
+  response_display_time good_bye_text""".split()
+
+# Optional settings and their default values:
+default_settings = {
+  "errors_allowed":1,
+  "optimal_matching":False,
+  "results_flush":"trial",
+  "results_fsync":False,
+  "no_repeat_window":0,
+  "refresh_rate":None,
+  "profile_dispatch":False,
+  "time_out_estimator":"mean_sd",
+  "time_out_trim":0.1,
+  "adaptive_time_out":False,
+  "session_plan_file":None}
+
+def complete_configuration(settings):
+  """
+  Adds default values for optional settings that are not given and
+  normalizes settings that may be given in more than one way.
+  """
+  for k, v in default_settings.items():
+    settings.setdefault(k, v)
+  # If there is just one level specified in the
+  # configuration file, we have to wrap it in a tuple:
+  for k in ("practice_levels", "levels"):
+    if k in settings and type(settings[k]) != tuple:
+      settings[k] = (settings[k],)
+
+def validate_configuration(settings, materials):
+  """
+  Checks the settings (see complete_configuration) and the compiled
+  materials for problems.  All problems are reported at once: the
+  function returns a list of errors and a list of warnings.
+  """
+  errors = []
+  warnings = []
+
+  # Make sure that all parameters are present in the configuration file:
+  missing = [k for k in required_settings if k not in settings]
+  if missing:
+    errors.append("Some settings are missing: " + ', '.join(missing))
+    return errors, warnings
+  s = settings
+
+  if type(s["errors_allowed"]) != int or s["errors_allowed"] < 1:
+    errors.append("errors_allowed should be a positive integer.")
+  if type(s["no_repeat_window"]) != int or s["no_repeat_window"] < 0:
+    errors.append("no_repeat_window should be a non-negative integer.")
+  if s["time_out_estimator"] not in time_out_estimators:
+    errors.append("time_out_estimator should be one of: " + ", ".join(time_out_estimators))
+  if type(s["time_out_trim"]) not in (int, float) or not 0 <= s["time_out_trim"] < 0.5:
+    errors.append("time_out_trim should be at least 0 and smaller than 0.5.")
+  if s["refresh_rate"] is not None and (type(s["refresh_rate"]) not in (int, float)
+                                        or s["refresh_rate"] <= 0):
+    errors.append("refresh_rate should be None or a positive number.")
+  if not (s["results_flush"] in ("line", "trial", "exit")
+          or (type(s["results_flush"]) == int and s["results_flush"] > 0)):
+    errors.append('results_flush should be "line", "trial", "exit", or a positive integer.')
+
+  # All levels should be integer values:
+  levels_ok = True
+  for k in ("practice_levels", "levels"):
+    if False in [type(x)==int for x in s[k]]:
+      errors.append("All values in %s shoud be integer values." % k)
+      levels_ok = False
+
+  # Check target items:
+
+  # Check whether targets are unique:
+  if materials["target_duplicates"]:
+    warnings.append("There are duplicates in the list of targets: "
+                    + ', '.join(materials["target_duplicates"]))
+
+  if levels_ok:
+    largest = max(s["practice_levels"] + s["levels"])
+    # The number of target items must be larger than the size of the
+    # largest level:
+    if materials["target_count"] <= largest:
+      errors.append("There are too few target items for the largest set size.")
+    # Warn if the number of targets is not resonably bigger than the
+    # max level:
+    elif materials["target_count"] < 2*largest:
+      warnings.append("There are very few target items.  They might repeat too often.")
+
+  # In case sloppy spelling is allowed, check if the target items have
+  # a sufficient damerau levenshtein distance to be unambiguously
+  # identifyable:
+  if s["allow_sloppy_spelling"] and materials["similar_targets"]:
+    errors.append("These target items are too similar to be used with sloppy spelling: "
+                  + "; ".join("%s, %s" % (a, b) for a, b in materials["similar_targets"]))
+
+  # Check processing items:
+
+  # Have enough practice trials for reliable time estimate:
+  if s["practice_processing_items"] - s["measure_time_after_trial"] < 1:
+    errors.append("Too few practice trials for getting a time estimate.")
+  elif s["practice_processing_items"] - s["measure_time_after_trial"] < 6:
+    warnings.append("Too few practice trials give you an unreliable estimate of the time needed by the participant to do the task.")
+
+  # Have unique processing items:
+  if materials["processing_duplicates"]:
+    warnings.append("There are duplicates in the list of operations: "
+                    + ', '.join(materials["processing_duplicates"]))
+
+  # Every processing item needs exactly one answer:
+  malformed = ["\t".join(l) for l in materials["processing_items"] if len(l) != 2]
+  if malformed:
+    errors.append("These verification items are not followed by a tab and an answer: "
+                  + "; ".join(malformed))
+
+  # Have enough processing items:
+  if levels_ok:
+    no_targets = sum(s["practice_levels"]) * s["practice_items_per_level"]
+    no_targets += sum(s["levels"]) * s["items_per_level"]
+    if no_targets > len(materials["processing_items"]):
+      errors.append("Not enough verification items. Only %d instead of %d." % (
+        len(materials["processing_items"]), no_targets))
+
+  # See that the resposes in the processing_items_file are the same
+  # as those in the configuration:
+  r = set([l[1] for l in materials["processing_items"] if len(l) == 2])
+  if set(s["responses"].keys()) != r:
+    errors.append("There is a response other than y and n for at least one verification item.")
+
+  return errors, warnings
+
+# Increase when the checks in validate_configuration change, so that
+# verdicts stored in material bundles are not reused:
+validation_version = 1
+
+def validate_task(config_file, settings):
+  """
+  Loads the compiled materials of a task and validates the
+  configuration.  The verdict is stored in the material bundle, keyed
+  by validation_version and the hash of the configuration file, so
+  that it is not recomputed as long as neither the checks, the
+  configuration, nor the materials change.  The material files are
+  looked up relative to the directory of the configuration file.
+  Returns the lists of errors and warnings and the materials.
+  """
+  with open(config_file, 'rb') as fh:
+    key = "%d-%s" % (validation_version, hashlib.sha256(fh.read()).hexdigest())
+  errors_allowed = settings.get("errors_allowed")
+  if type(errors_allowed) != int or errors_allowed < 1:
+    errors_allowed = default_settings["errors_allowed"]
+  filename = bundle_filename(config_file)
+  directory = os.path.dirname(config_file)
+  try:
+    materials = load_materials(os.path.join(directory, settings["target_items_file"]),
+                               os.path.join(directory, settings["processing_items_file"]),
+                               errors_allowed, filename)
+  except KeyError as e:
+    return ["Some settings are missing: %s" % e.args[0]], [], None
+  except (OSError, UnicodeDecodeError) as e:
+    return ["The materials could not be read: %s" % e], [], None
+
+  cache = materials.setdefault("validation", {})
+  if key not in cache:
+    errors, warnings = validate_configuration(settings, materials)
+    cache[key] = {"errors":errors, "warnings":warnings}
+    try:
+      write_json(materials, filename)
+    except OSError:
+      pass
+  verdict = cache[key]
+  return verdict["errors"], verdict["warnings"], materials
+
+# Increase when the structure of session plans changes:
+plan_version = 2
+
+# Settings that determine the structure of a session plan:
+plan_settings = ["practice_processing_items", "practice_levels",
+                 "practice_items_per_level", "levels", "items_per_level"]
+
+def plan_design(settings):
   """
-  Appends the given string plus a newline character to the file
-  containing the results.
+  The settings that a session plan was drawn for, in the form in which
+  they are stored in the plan (tuples become lists in JSON).
   """
-  with open(results_file, mode, encoding='utf-8') as fh:
-    fh.write(s + '\n')
+  return json.loads(json.dumps(dict((k, settings[k]) for k in plan_settings)))
+
+def plan_session(settings, materials, seed=None):
+  """
+  Draws all items for a session in advance.  Returns a plan (a
+  dictionary that can be stored as JSON) containing the processing
+  items of the first practice phase as (item, answer) pairs and, for
+  the practice and the test phase, the list of sets, each a list of
+  (processing item, answer, target) triples.  The hash of the
+  materials and the settings that determine the sets are stored as
+  well, so that a plan is not used with another task.  Plans with the
+  same seed are identical.
+  """
+  rng = random.Random(seed)
+  if settings["pseudo_random_targets"]:
+    targets = ShuffledItems(materials["targets"], settings["no_repeat_window"], rng)
+  else:
+    targets = RandomItems(materials["targets"], settings["no_repeat_window"], rng)
+  processing_items = ShuffledItems([tuple(l) for l in materials["processing_items"]],
+                                   rng=rng)
+
+  plan = {"version":plan_version, "seed":seed, "materials":materials["hash"],
+          "design":plan_design(settings)}
+  plan["processing_items"] = [next(processing_items)
+                              for i in range(settings["practice_processing_items"])]
+  for phase, levels, items_per_level in [
+      ("practice", settings["practice_levels"], settings["practice_items_per_level"]),
+      ("test", settings["levels"], settings["items_per_level"])]:
+    sizes = list(levels * items_per_level)
+    rng.shuffle(sizes)
+    plan[phase] = [[(element, answer, target) for (element, answer), target
+                    in zip([next(processing_items) for i in range(size)],
+                           targets.get_set(size))]
+                   for size in sizes]
+  return plan
+
+def configure(settings, materials):
+  """
+  Makes the settings of a task available to the scripts.  Also sets
+  up the index of target items used when scoring responses with
+  sloppy spelling.
+  """
+  globals().update(settings)
+  global single_letters, target_index, scored_policies
+  single_letters = materials["single_letters"]
+  # The scores with sloppy spelling are only meaningful if no two
+  # targets are within errors_allowed typos of each other:
+  scored_policies = [p for p in scoring_policies
+                     if not p[0] or not materials["similar_targets"]]
+  # Index for looking up the target matching a sloppily spelled
+  # response:
+  if allow_sloppy_spelling:
+    target_index = SimilarityIndex([x.lower() for x in materials["targets"]],
+                                   errors_allowed)
+  else:
+    target_index = None
+
+def session_scripts(plan, sink):
+  """
+  The scripts making up a session with the given plan.  Results are
+  written to sink.
+  """
+  return [Text(welcome_text, CENTER),
+          Text(instructions1),
+          PracticeProcessingItemsScript(plan["processing_items"]),
+          Text(instructions2),
+          TestScript(plan["practice"], "practice", sink),
+          Text(instructions3),
+          TestScript(plan["test"], "test", sink),
+          GoodbyeScript(sink)]
+
+def load_plan(filename, settings, materials):
+  """
+  Loads a session plan stored with write_json.  Raises ValueError if
+  the plan was not drawn from the given materials or for the given
+  settings.
+  """
+  with open(filename, encoding='utf-8') as fh:
+    plan = json.load(fh)
+  if plan.get("version") != plan_version:
+    raise ValueError("%s is not a session plan of this version of Py-Span-Task." % filename)
+  if plan.get("materials") != materials["hash"]:
+    raise ValueError("%s was drawn from other materials." % filename)
+  design = plan_design(settings)
+  differences = [k for k in plan_settings if plan["design"].get(k) != design[k]]
+  if differences:
+    raise ValueError("%s was drawn for other settings: %s"
+                     % (filename, ", ".join(differences)))
+  return plan
+
+def plan_main(argv):
+  """
+  Command line interface for creating session plans in advance.
+  """
+  parser = argparse.ArgumentParser(
+    prog="%s plan" % os.path.basename(sys.argv[0]),
+    description="Draw the items for a session in advance.")
+  parser.add_argument("config_file")
+  parser.add_argument("subject_id", help="used as the seed for drawing the items")
+  parser.add_argument("-o", "--output", help="file for the plan (default: SUBJECT_ID.plan.json)")
+  args = parser.parse_args(argv)
+
+  settings = read_configuration(args.config_file)
+  complete_configuration(settings)
+  errors, warnings, materials = validate_task(args.config_file, settings)
+  if errors:
+    print("\n".join(errors))
+    return 1
+  output = args.output or args.subject_id + ".plan.json"
+  write_json(plan_session(settings, materials, args.subject_id), output)
+  print(output)
+  return 0
 
 def request_subject_id():
   """
@@ -485,12 +1987,453 @@ class ask_if_warnings(object):
         else:
           print("Please enter y or n.")
 
+def read_protocol(filename):
+  """
+  Reads a results file written by Py-Span-Task.  Returns a dictionary
+  with the settings stored in the header, the column names, the data
+  rows (as lists of strings), the comment lines preceding the data,
+  and those following it (footer, e.g. the PCU scores).
+  """
+  settings = {}
+  comments = []
+  footer = []
+  columns = None
+  rows = []
+  for l in open(filename, encoding='utf-8'):
+    l = l.rstrip("\r\n")
+    if not l.strip():
+      continue
+    if l.startswith("#"):
+      mo = re.match(r"#\s*(\w+)\s*=\s*(.*)$", l)
+      if mo:
+        settings[mo.group(1)] = mo.group(2).strip()
+      if columns is None:
+        comments.append(l)
+      else:
+        footer.append(l)
+    elif columns is None:
+      columns = l.split("\t")
+    else:
+      row = l.split("\t")
+      row.extend([""] * (len(columns) - len(row)))
+      rows.append(row)
+  if columns is None:
+    raise ValueError("%s does not contain a table of results." % filename)
+  return {"settings":settings, "comments":comments, "columns":columns,
+          "rows":rows, "footer":footer}
+
+def is_results_table(columns):
+  """
+  Whether a table with the given columns is a table of results (and
+  not e.g. the timing statistics stored next to it).
+  """
+  return all(c in columns for c in ["phase", "num.items", "correctly.recalled",
+                                    "presented.items", "recalled.items"])
+
+def parse_bool(s):
+  """
+  Converts True/False (as written in the results header or given on
+  the command line) to a boolean.
+  """
+  if s.strip().lower() in ("true", "yes", "1"):
+    return True
+  if s.strip().lower() in ("false", "no", "0"):
+    return False
+  raise ValueError("Not a boolean value: %s" % s)
+
+# Cache shared by all protocols rescored in one process:
+rescore_cache = None
+
+def init_rescore_worker(cache_size):
+  global rescore_cache
+  rescore_cache = ScoreCache(cache_size)
+
+def rescore_protocol(filename, output_dir, allow_sloppy_spelling=None,
+                     heed_order=None, errors_allowed=None,
+                     optimal_matching=None, all_variants=False):
+  """
+  Recomputes correctly.recalled and the PCU score of a results file
+  and writes the rescored protocol to output_dir.  Scoring settings
+  that are None are taken from the header of the protocol.  If
+  all_variants is true, the scores under all combinations of
+  allow_sloppy_spelling and heed_order are added as extra columns.  As
+  in the test, the scores with sloppy spelling are NA if some of the
+  presented items are too similar to be told apart.  Returns the name
+  of the new file and the PCU score (None if there are no test sets),
+  or None if the file does not contain a table of results.
+  """
+  global rescore_cache
+  if rescore_cache is None:
+    rescore_cache = ScoreCache()
+  try:
+    protocol = read_protocol(filename)
+  except ValueError:
+    return None
+  if not is_results_table(protocol["columns"]):
+    return None
+  settings = protocol["settings"]
+  if allow_sloppy_spelling is None:
+    allow_sloppy_spelling = parse_bool(settings.get("allow_sloppy_spelling", "False"))
+  if heed_order is None:
+    heed_order = parse_bool(settings.get("heed_order", "False"))
+  if errors_allowed is None:
+    errors_allowed = int(settings.get("errors_allowed", "1"))
+  if optimal_matching is None:
+    optimal_matching = parse_bool(settings.get("optimal_matching", "False"))
+
+  columns = protocol["columns"]
+  phase = columns.index("phase")
+  num_items = columns.index("num.items")
+  recalled = columns.index("correctly.recalled")
+  presented_items = columns.index("presented.items")
+  recalled_items = columns.index("recalled.items")
+  if all_variants:
+    for p in scoring_policies:
+      if variant_column(p) not in columns:
+        columns.append(variant_column(p))
+        for row in protocol["rows"]:
+          row.append("")
+    # Single letters, for instance, all match each other with one
+    # typo:
+    presented = set(normalize_item(w) for row in protocol["rows"]
+                    for w in row[presented_items].split())
+    similar = SimilarityIndex(sorted(presented), errors_allowed).similar_pairs()
+    policies = [p for p in scoring_policies if not p[0] or not similar]
+  variant_proportions = dict((p, []) for p in scoring_policies)
+
+  proportion_recalled = []
+  for row in protocol["rows"]:
+    t = [normalize_item(w) for w in row[presented_items].split()]
+    s = [normalize_item(w) for w in row[recalled_items].split()]
+    if all_variants:
+      variants = score_variants(s, t, errors_allowed, None, optimal_matching,
+                                rescore_cache.distance)["scores"]
+      correct = variants[(allow_sloppy_spelling, heed_order)]
+      for p, n in variants.items():
+        if p not in policies:
+          row[columns.index(variant_column(p))] = "NA"
+          continue
+        row[columns.index(variant_column(p))] = str(n)
+        if row[phase] == "test":
+          variant_proportions[p].append(float(n) / float(row[num_items]))
+    else:
+      correct = rescore_cache.score(s, t, allow_sloppy_spelling, heed_order,
+                                    errors_allowed, None, optimal_matching)
+    row[recalled] = str(correct)
+    if row[phase] == "test":
+      proportion_recalled.append(float(correct) / float(row[num_items]))
+  pcu = mean(proportion_recalled) if proportion_recalled else None
+
+  new_settings = {"allow_sloppy_spelling":allow_sloppy_spelling,
+                  "heed_order":heed_order,
+                  "optimal_matching":optimal_matching}
+  if allow_sloppy_spelling:
+    new_settings["errors_allowed"] = errors_allowed
+  lines = []
+  for l in protocol["comments"]:
+    mo = re.match(r"#\s*(\w+)\s*=", l)
+    if mo and mo.group(1) in new_settings:
+      l = "# %s = %s" % (mo.group(1), new_settings.pop(mo.group(1)))
+    lines.append(l)
+  # Settings that were not stored in the original protocol:
+  for k, v in new_settings.items():
+    lines.append("# %s = %s" % (k, v))
+  lines.append("\t".join(columns))
+  lines.extend("\t".join(row) for row in protocol["rows"])
+  lines.append("# Partial credit unit score (PCU): %s" % format_score(pcu))
+  if all_variants:
+    for p in scoring_policies:
+      l = variant_proportions[p]
+      lines.append(pcu_variant_line(p, mean(l) if l else None))
+  # Other comments at the end (e.g. the lags of the session) are kept,
+  # the PCU scores are replaced by the ones computed above:
+  lines.extend(l for l in protocol["footer"]
+               if not l.startswith("# Partial credit unit score"))
+
+  output_file = os.path.join(output_dir, os.path.basename(filename))
+  writer = ResultsWriter(output_file, "exit")
+  for l in lines:
+    writer.write_line(l)
+  writer.close()
+  return output_file, pcu
+
+def rescore_main(argv):
+  """
+  Command line interface for rescoring a directory of results files.
+  """
+  parser = argparse.ArgumentParser(
+    prog="%s rescore" % os.path.basename(sys.argv[0]),
+    description="Recompute the scores in a directory of results files.")
+  parser.add_argument("directory", help="directory containing the results files")
+  parser.add_argument("-o", "--output", help="directory for the rescored files (default: DIRECTORY/rescored)")
+  parser.add_argument("--pattern", default="*.tsv", help="file name pattern (default: *.tsv)")
+  parser.add_argument("--allow-sloppy-spelling", type=parse_bool, metavar="BOOL")
+  parser.add_argument("--heed-order", type=parse_bool, metavar="BOOL")
+  parser.add_argument("--errors-allowed", type=int, metavar="K")
+  parser.add_argument("--optimal-matching", type=parse_bool, metavar="BOOL")
+  parser.add_argument("--all-variants", action="store_true", help="add the scores for all combinations of sloppy spelling and order")
+  parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+  parser.add_argument("--cache-size", type=int, default=65536, help="entries in the per-process score cache")
+  args = parser.parse_args(argv)
+
+  output_dir = args.output or os.path.join(args.directory, "rescored")
+  filenames = sorted(glob.glob(os.path.join(args.directory, args.pattern)))
+  if not filenames:
+    print("No results files found in %s." % args.directory)
+    return 1
+  os.makedirs(output_dir, exist_ok=True)
+
+  errors = 0
+  with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_rescore_worker,
+                           initargs=(args.cache_size,)) as executor:
+    futures = [executor.submit(rescore_protocol, f, output_dir,
+                               args.allow_sloppy_spelling, args.heed_order,
+                               args.errors_allowed, args.optimal_matching,
+                               args.all_variants)
+               for f in filenames]
+    for filename, future in zip(filenames, futures):
+      try:
+        result = future.result()
+        if result is None:
+          print("%s: not a results file, skipped" % filename, file=sys.stderr)
+          continue
+        output_file, pcu = result
+        print("%s\t%s" % (output_file, format_score(pcu)))
+      except Exception as e:
+        errors += 1
+        print("%s: %s" % (filename, e), file=sys.stderr)
+  return 1 if errors else 0
+
+class MemorySink(object):
+  """
+  Collects the lines of a results file in memory instead of writing
+  them to disk.
+  """
+
+  def __init__(self):
+    self.lines = []
+
+  def write_line(self, s):
+    self.lines.append(s)
+
+  def end_trial(self):
+    pass
+
+class SimulatedParticipant(object):
+  """
+  A participant for simulated sessions.  Response times to processing
+  items are log-normally distributed with mean rt_mean and standard
+  deviation rt_sd (in ms).  Processing items are verified correctly
+  with probability accuracy.  In sets with no more than capacity
+  items, all targets are recalled; in larger sets, each target is
+  recalled with probability capacity / set size.  Each recalled item
+  contains a typo with probability typo_rate.  Reading instructions
+  takes reading_time ms and typing each recalled item typing_time ms.
+  """
+
+  def __init__(self, rt_mean=1500, rt_sd=500, accuracy=0.9, capacity=4.0,
+               typo_rate=0.0, reading_time=10000, typing_time=1000, rng=None):
+    self.rng = rng or random.Random()
+    self.sigma = math.sqrt(math.log(1 + (rt_sd / rt_mean)**2))
+    self.mu = math.log(rt_mean) - self.sigma**2 / 2
+    self.accuracy = accuracy
+    self.capacity = capacity
+    self.typo_rate = typo_rate
+    self.reading_time = reading_time
+    self.typing_time = typing_time
+
+  def response_time(self):
+    return self.rng.lognormvariate(self.mu, self.sigma)
+
+  def verify(self, answer):
+    """
+    The key pressed in response to a processing item with the given
+    answer.
+    """
+    if self.rng.random() >= self.accuracy:
+      answer = self.rng.choice([a for a in responses if a != answer])
+    return responses[answer]
+
+  def recall(self, targets):
+    """
+    The list of items entered after a set with the given targets.
+    """
+    p = min(1.0, float(self.capacity) / len(targets))
+    recalled = [t for t in targets if self.rng.random() < p]
+    return [self.typo(t) if self.rng.random() < self.typo_rate else t
+            for t in recalled]
+
+  def typo(self, w):
+    """
+    Replaces a random character of w by a random letter.
+    """
+    i = self.rng.randrange(len(w))
+    c = self.rng.choice([c for c in "abcdefghijklmnopqrstuvwxyz" if c != w[i].lower()])
+    return w[:i] + c + w[i+1:]
+
+def simulate_session(settings, materials, participant, seed, profiler=None):
+  """
+  Runs a session with a simulated participant on a HeadlessFrame.  The
+  settings must have been made available with configure.  Returns a
+  dictionary with the PCU score (also under all scoring policies that
+  are meaningful for the targets), the proportion of correctly
+  verified processing items, the number of time-outs, and the duration
+  of the session in minutes.  Handlers are timed if a DispatchProfiler
+  is given.
+  """
+  sink = MemorySink()
+  frame = HeadlessFrame(*session_scripts(plan_session(settings, materials, seed), sink),
+                        profiler=profiler)
+  while frame.scripts:
+    script = frame.scripts[0]
+    if isinstance(script, TestScript) and script.next == script.store_results:
+      items = participant.recall(script.seen_targets)
+      frame.entry_var.set(" ".join(items))
+      frame.press("<Return>", participant.typing_time * max(1, len(items)))
+    elif isinstance(script, TestScript) and script.next == script.show_target:
+      rt = int(participant.response_time() * ns_per_ms)
+      if frame.now + rt >= script.deadline:
+        frame.step()              # time-out
+      else:
+        frame.press(participant.verify(script.desired_answer), rt / ns_per_ms)
+    elif (isinstance(script, PracticeProcessingItemsScript)
+          and script.next == script.store_results):
+      frame.press(participant.verify(script.desired_answer),
+                  participant.response_time())
+    elif frame.pending:
+      frame.step()
+    else:
+      frame.press("<space>", participant.reading_time)
+
+  rows = [dict(zip(results_columns, l.split("\t"))) for l in sink.lines
+          if not l.startswith("#")]
+  test = [r for r in rows if r["phase"] == "test"]
+  items = sum(int(r["num.items"]) for r in test)
+  result = {"pcu":frame.opts["pcu"],
+            "accuracy":float(sum(int(r["correctly.verified"]) for r in test)) / items,
+            "time.outs":sum(r["response.ns"].split().count("NA") for r in test),
+            "duration":frame.now / ns_per_ms / 60000.0}
+  for p, pcu in frame.opts["pcu_variants"].items():
+    result[variant_column(p).replace("correctly.recalled", "pcu")] = pcu
+  return result
+
+simulation_settings = None
+
+def init_simulation_worker(settings, materials):
+  global simulation_settings
+  configure(settings, materials)
+  simulation_settings = (settings, materials)
+
+def simulate_participants(seeds, participant_opts):
+  """
+  Simulates one participant per seed.  Participant parameters given
+  as (mean, sd) pairs vary between participants.
+  """
+  settings, materials = simulation_settings
+  results = []
+  for seed in seeds:
+    rng = random.Random(seed)
+    opts = {}
+    for k, v in participant_opts.items():
+      if type(v) == tuple:
+        v = max(0.0, rng.gauss(*v))
+      opts[k] = v
+    opts["accuracy"] = min(1.0, opts["accuracy"])
+    opts["typo_rate"] = min(1.0, opts["typo_rate"])
+    opts["rt_mean"] = max(1.0, opts["rt_mean"])
+    participant = SimulatedParticipant(rng=rng, **opts)
+    # The scripts report each set on standard output:
+    with contextlib.redirect_stdout(io.StringIO()):
+      results.append(simulate_session(settings, materials, participant, seed))
+  return results
+
+def positive_int(s):
+  """
+  Converts a number given on the command line that must be at least 1.
+  """
+  n = int(s)
+  if n < 1:
+    raise ValueError("Not a positive number: %s" % s)
+  return n
+
+def simulate_main(argv):
+  """
+  Command line interface for simulating sessions.
+  """
+  parser = argparse.ArgumentParser(
+    prog="%s simulate" % os.path.basename(sys.argv[0]),
+    description="Run simulated participants through a task and summarize their scores and session durations.")
+  parser.add_argument("config_file")
+  parser.add_argument("-n", "--participants", type=positive_int, default=1000)
+  parser.add_argument("--seed", default="simulation", help="seed for the simulation (default: simulation)")
+  parser.add_argument("--rt-mean", type=float, default=1500, help="mean response time to processing items in ms (default: 1500)")
+  parser.add_argument("--rt-sd", type=float, default=500, help="standard deviation of response times within a participant in ms (default: 500)")
+  parser.add_argument("--rt-mean-sd", type=float, default=300, help="standard deviation of the mean response time across participants (default: 300)")
+  parser.add_argument("--accuracy", type=float, default=0.9, help="proportion of correctly verified processing items (default: 0.9)")
+  parser.add_argument("--accuracy-sd", type=float, default=0.05)
+  parser.add_argument("--capacity", type=float, default=4.0, help="number of items recalled without loss (default: 4)")
+  parser.add_argument("--capacity-sd", type=float, default=1.0)
+  parser.add_argument("--typo-rate", type=float, default=0.02, help="probability of a typo in a recalled item (default: 0.02)")
+  parser.add_argument("-o", "--output", help="file for a table with the results of each simulated participant")
+  parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+  args = parser.parse_args(argv)
+
+  settings = read_configuration(args.config_file)
+  complete_configuration(settings)
+  errors, warnings, materials = validate_task(args.config_file, settings)
+  if errors:
+    print("\n".join(errors))
+    return 1
+
+  participant_opts = {"rt_mean":(args.rt_mean, args.rt_mean_sd), "rt_sd":args.rt_sd,
+                      "accuracy":(args.accuracy, args.accuracy_sd),
+                      "capacity":(args.capacity, args.capacity_sd),
+                      "typo_rate":args.typo_rate}
+  seeds = ["%s-%d" % (args.seed, i) for i in range(args.participants)]
+  jobs = args.jobs or os.cpu_count() or 1
+  chunks = [seeds[i::jobs * 4] for i in range(jobs * 4)]
+  results = []
+  with ProcessPoolExecutor(max_workers=jobs, initializer=init_simulation_worker,
+                           initargs=(settings, materials)) as executor:
+    for chunk in executor.map(simulate_participants, [c for c in chunks if c],
+                              [participant_opts] * len(chunks)):
+      results.extend(chunk)
+
+  measures = sorted(results[0])
+  print("measure\tmean\tsd\tp5\tp25\tmedian\tp75\tp95")
+  for m in measures:
+    l = [r[m] for r in results]
+    print("\t".join([m] + ["%.3f" % x for x in [mean(l), sd(l)]
+                           + [quantile(l, q) for q in (0.05, 0.25, 0.5, 0.75, 0.95)]]))
+  if args.output:
+    writer = ResultsWriter(args.output, "exit")
+    writer.write_line("\t".join(measures))
+    for r in results:
+      writer.write_line("\t".join("%.3f" % r[m] for m in measures))
+    writer.close()
+  return 0
+
 if __name__=="__main__":
 
+  # Offline tools:
+
+  if len(sys.argv) > 1 and sys.argv[1] == "rescore":
+    sys.exit(rescore_main(sys.argv[2:]))
+  if len(sys.argv) > 1 and sys.argv[1] == "compile-materials":
+    sys.exit(compile_materials_main(sys.argv[2:]))
+  if len(sys.argv) > 1 and sys.argv[1] == "plan":
+    sys.exit(plan_main(sys.argv[2:]))
+  if len(sys.argv) > 1 and sys.argv[1] == "simulate":
+    sys.exit(simulate_main(sys.argv[2:]))
+
   # Read configuration:
 
   if len(sys.argv) < 2:
     print("Usage: %s config_file [results_file]" % sys.argv[0])
+    print("       %s rescore directory [options]" % sys.argv[0])
+    print("       %s compile-materials task_directory" % sys.argv[0])
+    print("       %s plan config_file subject_id [-o plan_file]" % sys.argv[0])
+    print("       %s simulate config_file [options]" % sys.argv[0])
     sys.exit(1)
   else:
     config_file = sys.argv[1]
@@ -501,8 +2444,14 @@ if __name__=="__main__":
 
   # Check whether the output file already exists:
 
-  while os.path.exists(results_file):
-    print("A results file for this subject id already exists.")
+  # A journal (.part) is left behind by a session that crashed and
+  # holds the sets completed until then:
+  while os.path.exists(results_file) or os.path.exists(results_file + ".part"):
+    if os.path.exists(results_file):
+      print("A results file for this subject id already exists.")
+    else:
+      print("The results of an unfinished session for this subject id exist (%s)."
+            % (results_file + ".part"))
     print("Do you want to overwrite it? (y/n)")
     if sys.stdin.readline().strip() == "y":
       break
@@ -511,132 +2460,95 @@ if __name__=="__main__":
 
   # Load and sanity check the configuration:
 
-  exec(open(config_file).read())
+  settings = read_configuration(config_file)
+  complete_configuration(settings)
 
   with ask_if_warnings(lambda:sys.exit(1), "There were warnings.  Do you want to proceed?"):
-
-    # Make sure that all parameters are present in the configuration file:
-    t = set("""fontname fontname processing_items_file target_items_file responses
-      welcome_text instructions1 allow_sloppy_spelling practice_processing_items
-      measure_time_after_trial heed_order pseudo_random_targets practice_levels
-      practice_items_per_level practice_correct_response
-      practice_incorrect_response practice_summary instructions2 instructions3
-      levels items_per_level next_message finished_message
-      time_out_factor time_out_message target_display_time response_display_time
-      good_bye_text""".split())
-    if set(dir()).intersection(t) != t:
-      raise ValueError("Some settings are missing: "
-                       + ', '.join(t.difference(set(dir()))))
-
-    # If there is just one level specified in the
-    # configuration file, we have to wrap it in a tuple:
-    if type(practice_levels) != tuple:
-      practice_levels = (practice_levels,)
-    if type(levels) != tuple:
-      levels = (levels,)
-
-    # All levels should be integer values:
-    if False in [type(x)==int for x in practice_levels]:
-      raise ValueError("All values in practice_levels shoud be integer values.")
-    if False in [type(x)==int for x in levels]:
-      raise ValueError("All values in levels shoud be integer values.")
-
-    # Check target items:
-
-    # Check whether targets are unique:
-    t = [l.strip() for l in open(target_items_file, encoding='utf-8')]
-    if len(t)!=len(set(t)):
-      warn("There are duplicates in the list of targets: "
-           + ', '.join(duplicates(t)))
-
-    # The number of target items must be larger than the size of the
-    # largest level:
-    if len(t) <= max(practice_levels + levels):
-      raise ValueError("There are too few target items for the largest set size.")
-
-    # Check whether the targets are single letters/numbers
-    single_letters = all(len(x)==1 for x in t)
-
-    # Warn if the number of targets is not resonably bigger than the
-    # max level:
-    if len(t) < 2*max(practice_levels + levels):
-      warn("There are very few target items.  They might repeat too often.")
-
-    # In case sloppy spelling is allowed, check if the target items have
-    # a sufficient damerau levenshtein distance to be unambiguously
-    # identifyable:
-    if allow_sloppy_spelling:
-      for i in range(0, len(t)):
-        for j in range(i+1, len(t)):
-          if damerau_levenshtein(t[i], t[j]) < 2:
-            raise ValueError(("These target items are too similar to be used with sloppy spelling: %s, %s" % (t[i], t[j])).encode("utf-8"))
-
-    # Check processing items:
-
-    # Have enough practice trials for reliable time estimate:
-    if practice_processing_items - measure_time_after_trial < 1:
-      raise ValueError("Too few practice trials for getting a time estimate.")
-    if practice_processing_items - measure_time_after_trial < 6:
-      warn("Too few practice trials give you an unreliable estimate of the time needed by the participant to do the task.")
-
-    # Have unique processing items:
-    t = [l.strip() for l in open(processing_items_file, encoding='utf-8')]
-    if len(t)!=len(set(t)):
-      warn(("There are duplicates in the list of operations: "
-           + ', '.join(duplicates(t))).encode("utf-8"))
-
-    # Have enough processing items:
-    no_targets = sum(practice_levels) * practice_items_per_level
-    no_targets += sum(levels) * items_per_level
-    if no_targets > len(set(t)):
-      raise ValueError("Not enough verification items. Only %d instead of %d." % (
-        len(set(t)), no_targets))
-
-    # See that the resposes in the processing_items_file are the same
-    # as those in the configuration:
-    r = set([l.split("\t")[1] for l in t])
-    if set(responses.keys()) != r:
-      raise ValueError("There is a response other than y and n for at least one verification item.")
+    errors, warnings, materials = validate_task(config_file, settings)
+    for w in warnings:
+      warn(w)
+    if errors:
+      raise ValueError("\n".join(errors))
+
+  # A plan drawn in advance must fit the configuration and materials.
+  # Like the material files, it is found relative to the configuration
+  # file:
+  if settings["session_plan_file"]:
+    plan = load_plan(os.path.join(os.path.dirname(config_file),
+                                  settings["session_plan_file"]),
+                     settings, materials)
+
+  configure(settings, materials)
+  subject_id = os.path.splitext(os.path.basename(results_file))[0]
+
+  # Display durations can only be multiples of the refresh interval of
+  # the screen, so they are rounded to whole frames:
+  if refresh_rate is None:
+    refresh_rate = detect_refresh_rate()
+  display_frames = []
+  if refresh_rate:
+    for k in ("target_display_time", "response_display_time"):
+      frames, globals()[k] = frame_duration(globals()[k], refresh_rate)
+      display_frames.append((k, frames))
 
   # End sanity checks.
 
-  store_line("# Py-span-task", 'w')
-  store_line("# Written by Titus von der Malsburg <malsburg@posteo.de>")
-  store_line("# https://github.com/tmalsburg/py-span-task")
+  results_writer = ResultsWriter(results_file, results_flush, results_fsync)
+
+  results_writer.write_line("# Py-span-task")
+  results_writer.write_line("# Written by Titus von der Malsburg <malsburg@posteo.de>")
+  results_writer.write_line("# https://github.com/tmalsburg/py-span-task")
 
   # Store important settings:
 
-  store_line("# Settings:")
-  store_line("# subject id = %s" % results_file.split(".")[0])
-  store_line("# allow_sloppy_spelling = %s" % allow_sloppy_spelling)
-  store_line("# heed_order = %s" % heed_order)
-  store_line("# time_out_factor = %s" % time_out_factor)
+  results_writer.write_line("# Settings:")
+  results_writer.write_line("# subject id = %s" % subject_id)
+  results_writer.write_line("# allow_sloppy_spelling = %s" % allow_sloppy_spelling)
+  if allow_sloppy_spelling:
+    results_writer.write_line("# errors_allowed = %s" % errors_allowed)
+  results_writer.write_line("# heed_order = %s" % heed_order)
+  results_writer.write_line("# optimal_matching = %s" % optimal_matching)
+  results_writer.write_line("# time_out_factor = %s" % time_out_factor)
+  results_writer.write_line("# time_out_estimator = %s" % time_out_estimator)
+  if time_out_estimator == "trimmed":
+    results_writer.write_line("# time_out_trim = %s" % time_out_trim)
+  results_writer.write_line("# adaptive_time_out = %s" % adaptive_time_out)
+  results_writer.write_line("# clock = perf_counter_ns")
+  results_writer.write_line("# refresh_rate = %s" % refresh_rate)
+  if refresh_rate:
+    for k, frames in display_frames:
+      results_writer.write_line("# %s = %.3f (%d frames)" % (k, globals()[k], frames))
+  if session_plan_file:
+    results_writer.write_line("# session_plan_file = %s" % session_plan_file)
+
+  # The sets are appended to the table as they are completed:
+  results_writer.write_line("\t".join(results_columns))
+  results_writer.end_trial()
 
   # Prepare material:
 
-  if pseudo_random_targets:
-    target_items = ShuffledItems(target_items_file)
-  else:
-    target_items = RandomItems(target_items_file)
-
-  processing_items = shuffled_lines(processing_items_file)
+  # Draw all items in advance (unless a plan was given).  All random
+  # decisions are derived from the subject id, so that sessions can be
+  # reproduced.  The plan is stored next to the results for later
+  # inspection:
+  if not session_plan_file:
+    plan = plan_session(settings, materials, subject_id)
+  write_json(plan, os.path.splitext(results_file)[0] + ".plan.json")
 
   # Set up GUI and take off:
 
+  # Lags of scheduled callbacks are stored per set in a separate file
+  # (not .tsv, so that it is not mistaken for a results file):
+  lag_writer = ResultsWriter(os.path.splitext(results_file)[0] + ".lag.txt",
+                             results_flush, results_fsync)
+  lag_monitor = LagMonitor(lag_writer)
+  # Durations of the handlers of key presses and callbacks:
+  profiler = DispatchProfiler() if profile_dispatch else None
+
   root = tkinter.Tk()
   root.attributes('-fullscreen', True)
-  main_frame = MainFrame(root,
-                         Text(welcome_text, CENTER),
-                         Text(instructions1),
-                         PracticeProcessingItemsScript(processing_items),
-                         Text(instructions2),
-                         TestScript(processing_items, target_items,
-                                    practice_levels, practice_items_per_level,
-                                    "practice"),
-                         Text(instructions3),
-                         TestScript(processing_items, target_items, levels,
-                                    items_per_level, "test"),
-                         GoodbyeScript())
+  main_frame = MainFrame(root, *session_scripts(plan, results_writer),
+                         lags=lag_monitor, profiler=profiler)
   main_frame.pack(fill=BOTH, expand=1)
   # Make it cover the entire screen:
   w, h = root.winfo_screenwidth(), root.winfo_screenheight()
@@ -644,4 +2556,15 @@ if __name__=="__main__":
   root.geometry("%dx%d+0+0" % (w, h))
   # root.focus_set()                        # <-- move focus to this widget
   root.bind("<Escape>", lambda e: e.widget.quit())
-  root.mainloop()
+  try:
+    root.mainloop()
+  finally:
+    for l in lag_monitor.session_lines():
+      results_writer.write_line(l)
+    results_writer.close()
+    lag_writer.close()
+    if profiler:
+      profile_writer = ResultsWriter(os.path.splitext(results_file)[0] + ".profile.txt", "exit")
+      for l in profiler.lines():
+        profile_writer.write_line(l)
+      profile_writer.close()
@@ -1,11 +1,53 @@
 #!/usr/bin/env python
 
-import unittest
-from pyspantask import calculate_score
+import os, sys, json, random, tempfile, unittest, functools
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from pyspantask import calculate_score, damerau_levenshtein, bitparallel_damerau_levenshtein, SimilarityIndex, ScoreCache, read_protocol, rescore_protocol, score_variants, ResultsWriter, load_materials, read_configuration, complete_configuration, validate_configuration, validate_task, bundle_filename, ShuffledItems, RandomItems, plan_session, write_json, load_plan, timestamps, EventClock, LagMonitor, frame_duration, HeadlessFrame, configure, session_scripts, MemorySink, SimulatedParticipant, simulate_session, quantile, DispatchProfiler, MeanSDEstimator, MedianMADEstimator, TrimmedEstimator
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def load_task(name):
+  """
+  The completed settings and the materials of one of the tests
+  included in this repository.
+  """
+  directory = os.path.join(here, name)
+  settings = read_configuration(os.path.join(directory, "configuration.py"))
+  complete_configuration(settings)
+  materials = load_materials(os.path.join(directory, settings["target_items_file"]),
+                             os.path.join(directory, settings["processing_items_file"]))
+  return settings, materials
 
 class TestTask(unittest.TestCase):
 
   def test_calculate_score(self):
+    self.check_calculate_score(calculate_score)
+
+  def test_calculate_score_optimal_matching(self):
+    self.check_calculate_score(lambda s, t, sloppy, heed_order:
+                                 calculate_score(s, t, sloppy, heed_order, optimal_matching=True))
+
+    # A single response can only be credited once:
+    self.assertEqual(calculate_score(["ab"], ["abc", "abd"], True, False), 2)
+    self.assertEqual(calculate_score(["ab"], ["abc", "abd"], True, False, optimal_matching=True), 1)
+    self.assertEqual(calculate_score(["abd", "ab"], ["abc", "abd"], True, True, optimal_matching=True), 0)
+    self.assertEqual(calculate_score(["ab", "abd"], ["abc", "abd"], True, True, optimal_matching=True), 2)
+
+  def test_score_variants(self):
+    self.check_calculate_score(lambda s, t, sloppy, heed_order:
+                                 score_variants(s, t)["scores"][(sloppy, heed_order)])
+    variants = score_variants(["XX", "BB", "AA", "CC", "DX"], ["AA", "BB", "CC", "DD"])
+    self.assertEqual(variants["strict_hits"], ["BB", "AA", "CC"])
+    self.assertEqual(variants["lenient_hits"], ["BB", "AA", "CC", "DD"])
+    variants = score_variants(["ab"], ["abc", "abd"], optimal_matching=True)
+    self.assertEqual(variants["scores"], {(False, False):0, (False, True):0,
+                                          (True, False):1, (True, True):1})
+
+  def check_calculate_score(self, calculate_score):
     # Perfect match:
     self.assertEqual(calculate_score(["AA", "BB", "CC", "DD"], ["AA", "BB", "CC", "DD"], False, False), 4)
     self.assertEqual(calculate_score(["AA", "BB", "CC", "DD"], ["AA", "BB", "CC", "DD"], False, True), 4)
@@ -47,5 +89,535 @@ class TestTask(unittest.TestCase):
     self.assertEqual(calculate_score(["AA", "BB", "CC", "DD"], [], True, False), 0)
     self.assertEqual(calculate_score(["AA", "BB", "CC", "DD"], [], True, True), 0)
 
+  def test_damerau_levenshtein(self):
+    self.assertEqual(damerau_levenshtein("", ""), 0)
+    self.assertEqual(damerau_levenshtein("abc", ""), 3)
+    self.assertEqual(damerau_levenshtein("kitten", "sitting"), 3)
+    self.assertEqual(damerau_levenshtein("abcd", "abdc"), 1)
+    self.assertEqual(damerau_levenshtein("abcd", "abdc", transpositions=False), 2)
+    self.assertEqual(damerau_levenshtein(["AA", "BB"], ["BB", "AA"]), 1)
+
+    # Custom equality:
+    self.assertEqual(damerau_levenshtein("ABC", "abc", eq=lambda s,t:s.lower()==t.lower()), 0)
+
+    # Cut-off returns max_distance+1 as soon as the bound is exceeded:
+    self.assertEqual(damerau_levenshtein("kitten", "sitting", max_distance=3), 3)
+    self.assertEqual(damerau_levenshtein("kitten", "sitting", max_distance=2), 3)
+    self.assertEqual(damerau_levenshtein("kitten", "sitting", max_distance=0), 1)
+    self.assertEqual(damerau_levenshtein("a", "abcdef", max_distance=1), 2)
+
+  def test_bitparallel_damerau_levenshtein(self):
+    for s1, s2 in [("", ""), ("abc", ""), ("", "abc"), ("kitten", "sitting"),
+                   ("abcd", "abdc"), ("ca", "abc"), ("comunicación", "comunicacion"),
+                   ("x"*70 + "ab", "x"*70 + "ba")]:
+      self.assertEqual(bitparallel_damerau_levenshtein(s1, s2), damerau_levenshtein(s1, s2))
+      for k in range(3):
+        self.assertEqual(bitparallel_damerau_levenshtein(s1, s2, k), damerau_levenshtein(s1, s2, max_distance=k))
+
+  def test_calculate_score_errors_allowed(self):
+    self.assertEqual(calculate_score(["comunicasion", "abir"], ["comunicación", "abrir"], True, False, 1), 1)
+    self.assertEqual(calculate_score(["comunicasion", "abir"], ["comunicación", "abrir"], True, False, 2), 2)
+    self.assertEqual(calculate_score(["comunicasion", "abir"], ["comunicación", "abrir"], False, False, 2), 0)
+
+  def test_similarity_index(self):
+    index = SimilarityIndex(["haus", "maus", "baum", "raum", "auto", "hund"], 1)
+    self.assertEqual(index.similar_pairs(), [("haus", "maus", 1), ("baum", "raum", 1)])
+    self.assertEqual(index.query("hasu"), [("haus", 1)])
+    self.assertEqual(index.query("xyz"), [])
+    self.assertEqual(sorted(index.query("aus")), [("haus", 1), ("maus", 1)])
+    self.assertTrue("auto" in index)
+    self.assertFalse("aut" in index)
+    self.assertRaises(ValueError, index.query, "auto", 2)
+
+    # Scoring with the index gives the same results as without:
+    index = SimilarityIndex(["aa", "bb", "cc", "dd", "ee"], 1)
+    for s in [["bb", "aa", "cc", "dx"], ["xx", "bb", "aa", "cc", "dx"], []]:
+      for heed_order in [False, True]:
+        self.assertEqual(calculate_score(s, ["aa", "bb", "cc", "dd"], True, heed_order, 1, index),
+                         calculate_score(s, ["aa", "bb", "cc", "dd"], True, heed_order, 1))
+
+  def test_score_cache(self):
+    cache = ScoreCache(maxsize=2)
+    self.check_calculate_score(cache.score)
+    info = cache.info()
+    self.assertEqual((info["score_size"], info["distance_size"]), (2, 2))
+
+    cache = ScoreCache()
+    self.assertEqual(cache.score(["BB", "aa "], ["aa", "bb"], True, True), 0)
+    self.assertEqual(cache.score(["bb", "AA"], ["AA", "BB"], True, True), 0)
+    self.assertEqual(cache.score(["bb", "AA"], ["AA", "BB"], True, False), 2)
+    info = cache.info()
+    self.assertEqual((info["score_hits"], info["score_misses"]), (1, 2))
+    self.assertEqual(cache.distance("Haus", "maus", 1), 1)
+    self.assertEqual(cache.distance("haus", "MAUS", 1), 1)
+    self.assertEqual(cache.info()["distance_hits"], 1 + info["distance_hits"])
+
+  def test_rescore_protocol(self):
+    protocol = os.path.join(here, "JapaneseOperationSpan", "subject1.tsv")
+    with tempfile.TemporaryDirectory() as output_dir:
+      output_file, pcu = rescore_protocol(protocol, output_dir, heed_order=False,
+                                          all_variants=True)
+      self.assertAlmostEqual(pcu, 0.807, places=3)
+      rescored = read_protocol(output_file)
+      self.assertEqual(rescored["settings"]["heed_order"], "False")
+      self.assertEqual(rescored["settings"]["allow_sloppy_spelling"], "False")
+      self.assertEqual(rescored["columns"][:9], read_protocol(protocol)["columns"])
+      self.assertEqual(rescored["columns"][9], "correctly.recalled.exact.unordered")
+      self.assertEqual([r[3] for r in rescored["rows"] if r[0] == "test"][:3], ["6", "1", "5"])
+      self.assertEqual([r[10] for r in rescored["rows"] if r[0] == "test"][:3], ["4", "1", "3"])
+      # Single letters are too similar for scoring with sloppy spelling:
+      sloppy = rescored["columns"].index("correctly.recalled.sloppy.unordered")
+      self.assertEqual(set(r[sloppy] for r in rescored["rows"]), set(["NA"]))
+      with open(output_file, encoding='utf-8') as fh:
+        footer = [l.rstrip("\n") for l in fh if l.startswith("# Partial credit")]
+      self.assertTrue(footer[3].endswith("allow_sloppy_spelling True and heed_order False: NA"))
+      self.assertTrue(footer[1].endswith(": 0.807"))
+
+      # Comments following the table are kept:
+      with open(protocol, encoding='utf-8') as fh:
+        lines = fh.readlines()
+      with_lags = os.path.join(output_dir, "lags", "subject1.tsv")
+      os.mkdir(os.path.dirname(with_lags))
+      with open(with_lags, 'w', encoding='utf-8') as fh:
+        fh.writelines(lines + ["# after_callbacks = 12\n", "# after_lag_max_ns = 1500\n"])
+      output_file, pcu = rescore_protocol(with_lags, output_dir)
+      footer = read_protocol(output_file)["footer"]
+      self.assertEqual(footer, ["# Partial credit unit score (PCU): %.3f" % pcu,
+                                "# after_callbacks = 12", "# after_lag_max_ns = 1500"])
+
+      # Without test sets, there is no PCU score:
+      practice = os.path.join(output_dir, "practice", "subject2.tsv")
+      os.mkdir(os.path.dirname(practice))
+      with open(protocol, encoding='utf-8') as fh:
+        with open(practice, 'w', encoding='utf-8') as out:
+          out.writelines(l for l in fh if not l.startswith(("test", "# Partial")))
+      output_file, pcu = rescore_protocol(practice, output_dir, all_variants=True)
+      self.assertEqual(pcu, None)
+      with open(output_file, encoding='utf-8') as fh:
+        footer = [l.rstrip("\n") for l in fh if l.startswith("# Partial credit")]
+      self.assertEqual([l[-3:] for l in footer], [" NA"] * 5)
+
+      # Other tables stored next to the results files are skipped:
+      lags = os.path.join(output_dir, "subject1.lag.tsv")
+      with open(lags, 'w', encoding='utf-8') as fh:
+        fh.write("\t".join(LagMonitor.columns) + "\ntest\t1\t3\t100\t200\t300\n")
+      self.assertEqual(rescore_protocol(lags, output_dir), None)
+
+  @unittest.skipUnless(numpy, "NumPy is not installed")
+  def test_wm_scores(self):
+    sys.path.insert(0, os.path.join(here, "analysis_scripts"))
+    try:
+      from wmscores import wm_scores, is_results_file
+    finally:
+      sys.path.pop(0)
+    protocol = os.path.join(here, "JapaneseOperationSpan", "subject1.tsv")
+    # Values given by calculate_wmscores.R:
+    scores = wm_scores([protocol, protocol])
+    for m, v in [("wmc", 0), ("pcu", 0.729), ("anu", 0.333), ("pcl", 0.722),
+                 ("anl", 0.315), ("accuracy", 0.556)]:
+      self.assertEqual(len(scores[m]), 2)
+      self.assertAlmostEqual(scores[m][1], v, places=3)
+    self.assertEqual(wm_scores([protocol], threshold=0.3)["wmc"][0], 6)
+
+    # Other tables stored next to the results files are skipped:
+    with tempfile.TemporaryDirectory() as directory:
+      lags = os.path.join(directory, "subject1.lag.tsv")
+      with open(lags, 'w', encoding='utf-8') as fh:
+        fh.write("\t".join(LagMonitor.columns) + "\ntest\t1\t3\t100\t200\t300\n")
+      self.assertFalse(is_results_file(lags))
+      self.assertTrue(is_results_file(protocol))
+      scores = wm_scores([protocol, lags])
+      self.assertAlmostEqual(scores["pcu"][0], 0.729, places=3)
+
+  def test_results_writer(self):
+    with tempfile.TemporaryDirectory() as directory:
+      filename = os.path.join(directory, "subject.tsv")
+      writer = ResultsWriter(filename, flush_policy=2)
+      writer.write_line("a")
+      self.assertFalse(os.path.exists(filename))
+      self.assertEqual(open(filename + ".part").read(), "")
+      writer.write_line("b")
+      self.assertEqual(open(filename + ".part").read(), "a\nb\n")
+      writer.write_line("c")
+      writer.close()
+      writer.close()
+      self.assertFalse(os.path.exists(filename + ".part"))
+      self.assertEqual(open(filename).read(), "a\nb\nc\n")
+
+      writer = ResultsWriter(filename, flush_policy="trial", fsync=True)
+      writer.write_line("d")
+      writer.end_trial()
+      self.assertEqual(open(filename + ".part").read(), "d\n")
+      writer.close()
+      self.assertEqual(open(filename).read(), "d\n")
+
+      self.assertRaises(ValueError, ResultsWriter, filename, "sometimes")
+
+  def test_load_materials(self):
+    with tempfile.TemporaryDirectory() as directory:
+      targets = os.path.join(directory, "targets.txt")
+      processing_items = os.path.join(directory, "items.txt")
+      bundle = os.path.join(directory, "configuration.materials.json")
+      with open(targets, 'w', encoding='utf-8') as fh:
+        fh.write("Haus\nMaus\nBaum\nHaus\n")
+      with open(processing_items, 'w', encoding='utf-8') as fh:
+        fh.write("1 + 1 = 2\ty\n1 + 1 = 3 \tn\n")
+      materials = load_materials(targets, processing_items, 1, bundle)
+      self.assertEqual(materials["targets"], ["Haus", "Maus", "Baum"])
+      self.assertEqual(materials["target_count"], 4)
+      self.assertEqual(materials["target_duplicates"], ["Haus"])
+      self.assertEqual(materials["similar_targets"], [["Haus", "Maus"]])
+      self.assertEqual(materials["processing_items"], [["1 + 1 = 2", "y"], ["1 + 1 = 3", "n"]])
+      self.assertFalse(materials["single_letters"])
+      self.assertTrue(os.path.exists(bundle))
+      self.assertEqual(load_materials(targets, processing_items, 1, bundle), materials)
+
+      # Changes of the materials are detected:
+      with open(targets, 'a', encoding='utf-8') as fh:
+        fh.write("Raum\n")
+      self.assertEqual(load_materials(targets, processing_items, 1, bundle)["targets"],
+                       ["Haus", "Maus", "Baum", "Raum"])
+      self.assertNotEqual(load_materials(targets, processing_items, 2, bundle)["similar_targets"],
+                          materials["similar_targets"])
+
+  def test_validate_configuration(self):
+    directory = os.path.join(here, "SpanishOperationSpan")
+    settings = read_configuration(os.path.join(directory, "configuration.py"))
+    complete_configuration(settings)
+    files = [os.path.join(directory, settings["target_items_file"]),
+             os.path.join(directory, settings["processing_items_file"])]
+    self.assertEqual(validate_configuration(settings, load_materials(*files)), ([], []))
+
+    # All problems are reported at once:
+    materials = load_materials(*files, errors_allowed=2)
+    settings["levels"] = (2, 200)
+    settings["practice_processing_items"] = 7
+    settings["results_flush"] = "never"
+    errors, warnings = validate_configuration(settings, materials)
+    self.assertEqual(len(errors), 4)
+    self.assertTrue(errors[0].startswith("results_flush"))
+    self.assertTrue(errors[1].startswith("There are too few target items"))
+    self.assertTrue(errors[2].startswith("These target items are too similar"))
+    self.assertTrue(errors[3].startswith("Not enough verification items"))
+    self.assertEqual(len(warnings), 1)
+
+    del settings["fontsize"]
+    self.assertEqual(validate_configuration(settings, materials),
+                     (["Some settings are missing: fontsize"], []))
+
+  def test_validate_task(self):
+    import shutil, pyspantask
+    with tempfile.TemporaryDirectory() as directory:
+      for f in ["configuration.py", "consonants.txt", "operations.txt"]:
+        shutil.copy(os.path.join(here, "EnglishOperationSpan", f), directory)
+      config_file = os.path.join(directory, "configuration.py")
+      settings = read_configuration(config_file)
+      complete_configuration(settings)
+      # The material files are found relative to the configuration file:
+      errors, warnings, materials = validate_task(config_file, settings)
+      self.assertEqual(errors, [])
+      # The verdict is stored in the bundle, keyed by the version of the checks:
+      with open(bundle_filename(config_file), encoding='utf-8') as fh:
+        keys = list(json.load(fh)["validation"])
+      self.assertEqual(len(keys), 1)
+      self.assertTrue(keys[0].startswith("%d-" % pyspantask.validation_version))
+
+  def test_item_sources(self):
+    items = list("bcdfghjklm")
+    for source in [ShuffledItems, RandomItems]:
+      # Seeded sources are reproducible:
+      draws = [list(source(items, 3, random.Random("subject1")).get_set(4)) for i in range(2)]
+      self.assertEqual(draws[0], draws[1])
+
+      # No repetitions within a set or within the window:
+      s = source(items, 3, random.Random(1))
+      seen = []
+      for i in range(200):
+        seen.extend(s.get_set(random.Random(i).randint(1, 6)))
+      for i in range(len(seen) - 3):
+        self.assertEqual(len(set(seen[i:i+4])), 4)
+
+      # Items can be drawn one by one:
+      s = source(items, rng=random.Random(2))
+      self.assertTrue(next(s) in items)
+
+    # Shuffled items are all presented before they repeat:
+    s = ShuffledItems(items, 2, random.Random(3))
+    draws = [next(s) for i in range(30)]
+    self.assertEqual(sorted(draws[:10]), items)
+    counts = [draws.count(x) for x in items]
+    self.assertTrue(max(counts) - min(counts) <= 1)
+
+    # Random items work with a small pool and sets as large as the pool:
+    self.assertEqual(sorted(RandomItems(items, 0, random.Random(4)).get_set(10)), items)
+
+  def test_plan_session(self):
+    settings, materials = load_task("EnglishOperationSpan")
+    plan = plan_session(settings, materials, "subject1")
+    self.assertEqual(len(plan["processing_items"]), settings["practice_processing_items"])
+    for phase, levels, items_per_level in [
+        ("practice", settings["practice_levels"], settings["practice_items_per_level"]),
+        ("test", settings["levels"], settings["items_per_level"])]:
+      self.assertEqual(sorted(len(s) for s in plan[phase]),
+                       sorted(levels * items_per_level))
+      for s in plan[phase]:
+        self.assertEqual(len(set(t for e, a, t in s)), len(s))
+        for element, answer, target in s:
+          self.assertTrue(target in materials["targets"])
+          self.assertTrue([element, answer] in materials["processing_items"])
+
+    # Plans are reproducible and survive a round trip through a file:
+    self.assertEqual(plan_session(settings, materials, "subject1"), plan)
+    self.assertNotEqual(plan_session(settings, materials, "subject2"), plan)
+    with tempfile.TemporaryDirectory() as directory:
+      filename = os.path.join(directory, "subject1.plan.json")
+      write_json(plan, filename)
+      loaded = load_plan(filename, settings, materials)
+      self.assertEqual(loaded["test"], [[list(x) for x in s] for s in plan["test"]])
+
+      # Plans are only used with the design and materials they were drawn for:
+      changed = dict(settings, practice_processing_items=settings["practice_processing_items"] + 3)
+      self.assertRaises(ValueError, load_plan, filename, changed, materials)
+      changed = dict(settings, levels=tuple(settings["levels"]) + (9,))
+      self.assertRaises(ValueError, load_plan, filename, changed, materials)
+      self.assertRaises(ValueError, load_plan, filename, settings, dict(materials, hash="x"))
+
+  def test_timestamps(self):
+    self.assertEqual(timestamps([]), "")
+    self.assertEqual(timestamps([1090954285838, None, 3]), "1090954285838 NA 3")
+
+  def test_event_clock(self):
+    now = [5000000000]
+    clock = EventClock(lambda:now[0])
+    # The fastest event determines the offset:
+    self.assertEqual(clock.align(1000), (5000000000, 0))
+    now[0] += 530000000
+    self.assertEqual(clock.align(1500), (5500000000, 30000000))
+    now[0] += 490000000
+    self.assertEqual(clock.align(2010), (6010000000, 10000000))
+    # Events without timestamps are timed when they are handled:
+    self.assertEqual(clock.align("??"), (now[0], None))
+    # Timestamps of the window system wrap around:
+    clock = EventClock(lambda:now[0])
+    clock.align(2**32 - 100)
+    now[0] += 200000000
+    self.assertEqual(clock.align(100), (now[0], 0))
+
+  def test_lag_monitor(self):
+    sink = MemorySink()
+    lags = LagMonitor(sink)
+    self.assertEqual(lags.session_lines(), [])
+    lags.record(500000)
+    lags.start_trial()
+    for lag in range(1, 21):
+      lags.record(lag * 1000000)
+    lags.end_trial("test", 1)
+    lags.end_trial("test", 2)
+    self.assertEqual(sink.lines, ["\t".join(LagMonitor.columns),
+                                  "test\t1\t20\t10500000\t19000000\t20000000"])
+    self.assertEqual(lags.session_lines(),
+                     ["# after_callbacks = 21", "# after_lag_mean_ns = 10023809",
+                      "# after_lag_p95_ns = 19000000", "# after_lag_max_ns = 20000000"])
+
+  def test_frame_duration(self):
+    self.assertEqual(frame_duration(1000, 60), (60, 1000.0))
+    self.assertEqual(frame_duration(800, 60), (48, 800.0))
+    frames, ms = frame_duration(1000, 144)
+    self.assertEqual(frames, 144)
+    frames, ms = frame_duration(500, 144)
+    self.assertEqual(frames, 72)
+    frames, ms = frame_duration(10, 144)
+    self.assertEqual(frames, 1)
+    self.assertAlmostEqual(ms, 6.944, 3)
+    frames, ms = frame_duration(1000, 59.94)
+    self.assertEqual(frames, 60)
+    self.assertAlmostEqual(ms, 1001.001, 3)
+    self.assertEqual(frame_duration(1, 60)[0], 1)
+
+  def run_headless_session(self, rt, recall=lambda targets:targets):
+    """
+    Runs a session of the English operation span task with a simulated
+    participant who verifies processing items correctly after rt ms
+    (None for never) and recalls the targets returned by recall.
+    """
+    import pyspantask
+    settings, materials = load_task("EnglishOperationSpan")
+    configure(settings, materials)
+    sink = MemorySink()
+    frame = HeadlessFrame(*session_scripts(plan_session(settings, materials, "subject1"), sink))
+    for i in range(100000):
+      if not frame.scripts:
+        break
+      script = frame.scripts[0]
+      if isinstance(script, pyspantask.TestScript) and script.next == script.store_results:
+        frame.entry_var.set(" ".join(recall(script.seen_targets)))
+        frame.press("<Return>", 3000)
+      elif script.next in (getattr(script, "show_target", None),
+                           getattr(script, "store_results", None)):
+        if rt is None and isinstance(script, pyspantask.TestScript):
+          frame.step()
+        else:
+          frame.press(pyspantask.responses[script.desired_answer], rt or 800)
+      elif frame.pending:
+        frame.step()
+      else:
+        frame.press("<space>", 1000)
+    self.assertEqual(frame.scripts, [])
+    return settings, sink.lines
+
+  def test_headless_session(self):
+    settings, lines = self.run_headless_session(800)
+    sets = [l.split("\t") for l in lines if not l.startswith("#")]
+    self.assertEqual(len(sets), len(settings["practice_levels"]) * settings["practice_items_per_level"]
+                     + len(settings["levels"]) * settings["items_per_level"])
+    for s in sets:
+      self.assertEqual(s[3], s[2])      # all targets recalled
+      self.assertEqual(s[4], s[2])      # all processing items verified
+      self.assertEqual(s[5], "800")     # response times on the virtual clock
+      self.assertEqual(s[7], s[8])
+      self.assertEqual(len(s[13].split()), int(s[2]))
+    # Without adaptive_time_out, all elements have the same time-out:
+    self.assertEqual(len(set(x for s in sets for x in s[13].split())), 1)
+    self.assertTrue("# Partial credit unit score (PCU): 1.000" in lines)
+
+    # Without responses, every element times out:
+    settings, lines = self.run_headless_session(None, lambda targets:targets[:1])
+    for s in [l.split("\t") for l in lines if not l.startswith("#")]:
+      self.assertEqual(s[3], "1")
+      self.assertEqual(s[4], "0")
+      self.assertEqual(set(s[11].split()), set(["NA"]))
+    self.assertFalse("# Partial credit unit score (PCU): 1.000" in lines)
+
+  def test_headless_clock(self):
+    frame = HeadlessFrame()
+    calls = []
+    frame.at(1000000007, lambda:calls.append(frame.now))
+    frame.at(333333333, lambda:calls.append(frame.now))
+    frame.step()
+    frame.step()
+    # Callbacks are called exactly at their deadlines:
+    self.assertEqual(calls, [333333333, 1000000007])
+    frame.advance(0.5)
+    self.assertEqual(frame.now, 1000500007)
+
+  def test_simulate_session(self):
+    settings, materials = load_task("EnglishOperationSpan")
+    configure(settings, materials)
+
+    perfect = SimulatedParticipant(rt_mean=1000, rt_sd=1, accuracy=1.0, capacity=10,
+                                   rng=random.Random(1))
+    result = simulate_session(settings, materials, perfect, "subject1")
+    self.assertEqual(result["pcu"], 1.0)
+    self.assertEqual(result["accuracy"], 1.0)
+    self.assertEqual(result["time.outs"], 0)
+    self.assertTrue(5 < result["duration"] < 15)
+
+    # Sessions are reproducible:
+    results = [simulate_session(settings, materials,
+                                SimulatedParticipant(capacity=2, typo_rate=0.2,
+                                                     rng=random.Random(2)),
+                                "subject1")
+               for i in range(2)]
+    self.assertEqual(results[0], results[1])
+    self.assertTrue(results[0]["pcu"] < 1.0)
+    self.assertTrue(results[0]["pcu.exact.unordered"] >= results[0]["pcu.exact.ordered"])
+    # Single letters are too similar for scoring with sloppy spelling:
+    self.assertFalse("pcu.sloppy.unordered" in results[0])
+
+    # Participants whose response times vary a lot run into time-outs:
+    erratic = SimulatedParticipant(rt_mean=1500, rt_sd=3000, accuracy=1.0,
+                                   rng=random.Random(3))
+    result = simulate_session(settings, materials, erratic, "subject1")
+    self.assertTrue(result["time.outs"] > 0)
+    self.assertTrue(result["accuracy"] < 1.0)
+
+  def test_dispatch_profiler(self):
+    now = [0]
+    def clock():
+      now[0] += 5000
+      return now[0]
+    profiler = DispatchProfiler(clock)
+    def handler(x):
+      now[0] += x
+      return x
+    self.assertEqual(profiler.call(handler, 1000), 1000)
+    profiler.call(handler, 2000000)
+    profiler.record("slow", 10**9)
+    lines = profiler.lines()
+    self.assertEqual(lines[0].split("\t")[:5], ["handler", "calls", "total.ns", "mean.ns", "max.ns"])
+    self.assertEqual(lines[1], "slow\t1\t1000000000\t1000000000\t1000000000\t0\t0\t0\t0\t0\t1")
+    name = handler.__qualname__
+    self.assertEqual(lines[2], name + "\t2\t2011000\t1005500\t2005000\t1\t0\t0\t1\t0\t0")
+
+    # Handlers of scripts are named after their class and method:
+    settings, materials = load_task("EnglishOperationSpan")
+    configure(settings, materials)
+    profiler = DispatchProfiler()
+    simulate_session(settings, materials, SimulatedParticipant(rng=random.Random(1)),
+                     "subject1", profiler)
+    for name in ["TestScript.store_results", "TestScript.show_element",
+                 "TestScript.finish_set", "PracticeProcessingItemsScript.store_results",
+                 "PracticeProcessingItemsScript.show_results", "Text.next"]:
+      self.assertTrue(name in profiler.handlers)
+    self.assertFalse(any("<lambda>" in name for name in profiler.handlers))
+
+    # Scheduled callbacks are named after the method they wrap:
+    self.assertEqual(DispatchProfiler.name(functools.partial(profiler.record, "x")),
+                     "DispatchProfiler.record")
+
+  def test_time_out_estimators(self):
+    from pyspantask import mean, sd
+    rng = random.Random(1)
+    intervals = [int(rng.gauss(2000, 300) * 1000000) for i in range(20)]
+    estimators = [MeanSDEstimator(), MedianMADEstimator(), TrimmedEstimator(0.1)]
+    for x in intervals:
+      for e in estimators:
+        e.add(x)
+    # Same time-out as computed from the complete list:
+    m, s = estimators[0].estimate()
+    self.assertAlmostEqual(m, mean(intervals), delta=1)
+    self.assertAlmostEqual(s, sd(intervals), delta=1)
+    self.assertEqual(estimators[0].time_out(1), int((mean(intervals) + sd(intervals)) / 1000000))
+
+    # A distracted trial inflates mean and SD but not the robust estimates:
+    before = [e.time_out(1) for e in estimators]
+    for e in estimators:
+      e.add(60000 * 1000000)
+    after = [e.time_out(1) for e in estimators]
+    self.assertTrue(after[0] > before[0] + 10000)
+    self.assertTrue(abs(after[1] - before[1]) < 200)
+    self.assertTrue(abs(after[2] - before[2]) < 200)
+
+    self.assertRaises(ValueError, MeanSDEstimator().estimate)
+    e = TrimmedEstimator(0.4)
+    e.add(5)
+    self.assertEqual(e.estimate(), (5.0, 0.0))
+
+  def test_adaptive_time_out(self):
+    settings, materials = load_task("EnglishOperationSpan")
+    time_outs = {}
+    for adaptive in [False, True]:
+      settings["adaptive_time_out"] = adaptive
+      configure(settings, materials)
+      participant = SimulatedParticipant(rt_mean=2000, rt_sd=200, accuracy=1.0,
+                                         rng=random.Random(1))
+      # The participant slows down after the practice phase:
+      response_time = participant.response_time
+      seen = []
+      def slow():
+        seen.append(1)
+        return response_time() * (1 if len(seen) <= 40 else 1.6)
+      participant.response_time = slow
+      time_outs[adaptive] = simulate_session(settings, materials, participant, "subject1")["time.outs"]
+    settings["adaptive_time_out"] = False
+    configure(settings, materials)
+    self.assertTrue(time_outs[True] < time_outs[False], time_outs)
+
+  def test_quantile(self):
+    self.assertEqual(quantile([3, 1, 2], 0.5), 2)
+    self.assertEqual(quantile([1, 2, 3, 4], 0.5), 2.5)
+    self.assertEqual(quantile([5], 0.95), 5)
+    self.assertEqual(quantile([0, 10], 0.95), 9.5)
+
 if __name__ == '__main__':
     unittest.main()